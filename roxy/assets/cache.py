@@ -0,0 +1,66 @@
+import os
+import hashlib
+import logging
+
+
+logger = logging.getLogger('roxy')
+
+
+class DerivativeCache(object):
+    """
+    a directory of derived files, such as image previews, named by a digest
+    of everything which went into deriving them
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, *parts):
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def path_for(self, key, extension):
+        return os.path.join(self.path, key[:2], '{}.{}'.format(key, extension))
+
+    def get(self, key, extension):
+        """the path of the cached file, or None if it has not been derived"""
+        path = self.path_for(key, extension)
+        if not os.path.exists(path):
+            return None
+
+        # the modification time orders entries for eviction
+        os.utime(path, None)
+        return path
+
+    def reserve(self, key, extension):
+        """the path which a new entry should be written to"""
+        path = self.path_for(key, extension)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return path
+
+    def evict(self):
+        """removes the least recently used entries until within `max_size`"""
+        if not self.max_size or not os.path.exists(self.path):
+            return 0
+
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                path = os.path.join(root, f)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        removed = 0
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, path = entries.pop(0)
+            os.remove(path)
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info("evicted {} entries from {}".format(removed, self.path))
+        return removed
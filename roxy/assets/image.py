@@ -1,9 +1,116 @@
 import os
+import logging
+import resource
+import multiprocessing
 
 from PIL import Image, ImageOps
 
 import roxy.util as util
 from roxy.model import Asset
+from roxy.events import AfterWrite
+from roxy.assets.cache import DerivativeCache
+
+
+logger = logging.getLogger('roxy')
+_pool = None
+_cache = None
+_derivations = {}
+
+
+def get_pool(config):
+    """the pool which image work is sent to, created on first use"""
+    global _pool
+    if _pool is None:
+        processes = config['image_jobs']
+        limit = config['image_worker_memory']
+        logger.debug("starting {} image workers".format(processes))
+        _pool = multiprocessing.Pool(processes, _init_worker, (limit,),
+                                     maxtasksperchild=config['image_worker_tasks'])
+    return _pool
+
+
+@AfterWrite.subscribe
+def close_pool(*args, **kwargs):
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+    _derivations.clear()
+
+
+def get_cache(config):
+    """the cache of image derivatives, see `DerivativeCache`"""
+    global _cache
+    if _cache is None:
+        _cache = DerivativeCache(config['image_cache_path'],
+                                 config['image_cache_size'])
+    return _cache
+
+
+@AfterWrite.subscribe
+def evict_cache(*args, **kwargs):
+    global _cache
+    if _cache is not None:
+        _cache.evict()
+        _cache = None
+
+
+def derive(config, key, extension, fn, source, *args, **kwargs):
+    """
+    the path of the cached derivative `key`, written by
+    `fn(source, path, *args, **kwargs)` in the pool unless already cached,
+    and the result to wait for before using it, or None; a key requested
+    more than once in a build is only derived once
+    """
+    cache = get_cache(config)
+    if key in _derivations:
+        return _derivations[key]
+
+    path = cache.get(key, extension)
+    if path is not None:
+        return path, None
+
+    path = cache.reserve(key, extension)
+    result = get_pool(config).apply_async(fn, (source, path) + args, kwargs)
+    _derivations[key] = path, result
+    return _derivations[key]
+
+
+def _init_worker(limit):
+    # cap the address space of the worker, so that a huge image fails its
+    # own job instead of taking down the build
+    if limit:
+        limit = limit * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def fit(source, dest, bounds, fmt, centering=(0.5, 0.5), clamp=False):
+    """
+    writes a copy of `source` cropped and scaled to `bounds` to `dest`; with
+    `clamp`, the bounds are limited to the size of the source
+    """
+    image = Image.open(source)
+    if clamp:
+        bounds = [min(image.size[i], bounds[i]) for i in range(2)]
+
+    preview = ImageOps.fit(image, tuple(bounds), centering=centering,
+                           method=Image.ANTIALIAS)
+    _save(preview, dest, fmt)
+    return dest
+
+
+def convert(source, dest, fmt):
+    """writes a copy of `source` in format `fmt` to `dest`"""
+    image = Image.open(source)
+    _save(image, dest, fmt)
+    return dest
+
+
+def _save(image, dest, fmt):
+    # never leave a partial file at `dest`, it may be a cache entry
+    with util.replacing(dest, suffix='.part') as partial:
+        image.save(partial, format=fmt)
 
 
 def process(config, metadata, path, asset=None):
@@ -27,25 +134,26 @@ def process(config, metadata, path, asset=None):
     elif fmt == 'PNG':
         ext = 'png'
 
-    path = os.path.join(conf['asset_build_path'], '{}.{}'.format(fname, ext))
-    dirname = os.path.dirname(path)
+    dest = os.path.join(conf['asset_build_path'], '{}.{}'.format(fname, ext))
+    dirname = os.path.dirname(dest)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    copy = image.copy()
-    copy.save(path, format=fmt)
+    # only the header has been read, the pixels are decoded by the workers
     asset.width, asset.height = image.size
+    pool = get_pool(config)
+    pending = [(None, pool.apply_async(convert, (path, dest, fmt)))]
 
     for name, spec in preview_specs.items():
-        path = os.path.join(conf['asset_build_path'],
+        dest = os.path.join(conf['asset_build_path'],
                             '{}-{}.{}'.format(fname, name, ext))
-        preview = ImageOps.fit(image,
-                               (spec[0], spec[1]),
-                               centering=(spec[2], spec[3]),
-                               method=Image.ANTIALIAS)
-        preview.save(path, format=fmt)
-        relative_path = os.path.relpath(path, conf['asset_build_path'])
-        setattr(asset, name, relative_path)
+        args = (path, dest, (spec[0], spec[1]), fmt, (spec[2], spec[3]))
+        pending.append((name, pool.apply_async(fit, args)))
+
+    for name, result in pending:
+        dest = result.get()
+        if name is not None:
+            setattr(asset, name, os.path.relpath(dest, conf['asset_build_path']))
 
     for k, v in metadata.items():
         if not k.startswith('image_') or k.startswith('asset_'):
@@ -0,0 +1,436 @@
+"""
+Benchmark builds of synthetic sites
+
+Usage:
+    roxy-benchmark [--scales=SCALES] [--root=DIR] [--templates=DIR]
+                   [--pages=N] [--tags=N] [--properties=N] [--images=N]
+                   [--repeat=N] [--output=FILE] [--baseline=FILE]
+                   [--threshold=PCT] [--max-exponent=E]
+    roxy-benchmark (-h | --help)
+
+Options:
+    -h, --help              Show this text
+    --scales=SCALES         Comma-separated numbers of posts [default: 100,1000]
+    --root=DIR              Where synthetic sites are written [default: benchmark]
+    --templates=DIR         Templates for the blog generator [default: example/templates]
+    --pages=N               Pages per 100 posts [default: 10]
+    --tags=N                Distinct tags per 100 posts [default: 5]
+    --properties=N          Extra properties per document [default: 5]
+    --images=N              Images per 100 posts [default: 2]
+    --repeat=N              Runs of each scale, the fastest is kept [default: 1]
+    --output=FILE           Write the results as JSON
+    --baseline=FILE         Compare against results written by --output
+    --threshold=PCT         Slowdown from the baseline reported as a regression [default: 25]
+    --max-exponent=E        Growth between scales reported as a regression,
+                            e.g. 2 is quadratic [default: 1.5]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import platform
+import traceback
+import multiprocessing
+from Queue import Empty
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from docopt import docopt
+
+
+logger = logging.getLogger('roxy')
+
+SITE = 'bench'
+
+SITE_INI = """\
+[roxy]
+timezone = UTC
+document_formats = markdown
+
+[site:{site}]
+name = Benchmark
+url = http://example.com/
+url_base = http://example.com/
+generator = roxy.generators.blog
+
+content_source_path = %(here)s/content
+asset_source_path = %(here)s/assets
+template_path = {templates}
+build_path = %(here)s/site
+
+[jinja2]
+filters = roxy.filters
+
+[loggers]
+keys = root, roxy, sqlalchemy
+
+[handlers]
+keys = console
+
+[formatters]
+keys = generic
+
+[logger_root]
+level = WARN
+handlers = console
+
+[logger_roxy]
+level = WARN
+handlers =
+qualname = roxy
+
+[logger_sqlalchemy]
+level = WARN
+handlers =
+qualname = sqlalchemy.engine
+
+[handler_console]
+class = StreamHandler
+args = (sys.stderr,)
+level = NOTSET
+formatter = generic
+
+[formatter_generic]
+format = %(asctime)s %(levelname)-8.8s [%(name)s] %(message)s
+"""
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit etiam
+sollicitudin quam interdum vitae tristique leo pharetra nam convallis tellus
+cursus praesent augue mattis consequat odio enim sem venenatis libero metus
+curabitur dui sagittis lacus vel sapien fermentum duis vulputate dapibus
+viverra malesuada condimentum ornare accumsan maecenas velit nullam neque
+placerat nulla porta magna aliquam erat volutpat aenean risus""".split()
+
+# the queries made by roxy.generators.blog
+QUERIES = [
+    ('pages', lambda site, threshold:
+        site.content.filter(type='page').all()),
+    ('new posts', lambda site, threshold:
+        site.content.filter(type='post', publish_time={'after': threshold}).all()),
+    ('archived posts', lambda site, threshold:
+        site.content.filter(type='post', publish_time={'on_before': threshold}).all()),
+    ('popular posts', lambda site, threshold:
+        site.content.filter(type='post').order_by(desc=['likes']).limit(10).all()),
+    ('tagged posts', lambda site, threshold:
+        site.content.filter(tags=['awesome', 'dude']).order_by(desc=['likes']).limit(10).all()),
+    ('tags', lambda site, threshold:
+        site.tags.all()),
+]
+
+
+def main(argv=sys.argv):
+    arguments = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    scales = sorted(int(s) for s in arguments['--scales'].split(','))
+    params = dict((k, int(arguments['--' + k]))
+                  for k in ('pages', 'tags', 'properties', 'images'))
+    templates = os.path.abspath(arguments['--templates'])
+    repeat = int(arguments['--repeat'])
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': datetime.utcnow().isoformat(),
+        'parameters': params,
+        'scales': {},
+    }
+    for n in scales:
+        path = os.path.abspath(os.path.join(arguments['--root'], str(n)))
+        logger.info("generating a site of {} posts in {}".format(n, path))
+        synthesize(path, templates, n, **params)
+
+        runs = [run(path) for _ in range(repeat)]
+        results['scales'][str(n)] = {
+            'timings': dict((k, min(r['timings'][k] for r in runs))
+                            for k in runs[0]['timings']),
+            'statements': runs[0]['statements'],
+        }
+
+    report(results)
+    regressions = check_scaling(results, float(arguments['--max-exponent']))
+
+    if arguments['--baseline']:
+        with open(arguments['--baseline'], 'rb') as f:
+            baseline = json.load(f)
+        regressions += compare(results, baseline,
+                               float(arguments['--threshold']) / 100)
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info("wrote results to {}".format(arguments['--output']))
+
+    if regressions:
+        sys.exit(1)
+
+
+def synthesize(path, templates, posts, pages=10, tags=5, properties=5, images=2):
+    """
+    writes an example-style site of `posts` posts, with `pages`, `tags` and
+    `images` per 100 posts, to `path`; posts are dated over the two years
+    before today, otherwise the same arguments write the same site
+    """
+    rand = random.Random(posts)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    content = os.path.join(path, 'content')
+    assets = os.path.join(path, 'assets', 'images')
+    os.makedirs(content)
+    os.makedirs(assets)
+
+    with open(os.path.join(path, 'site.ini'), 'wb') as f:
+        f.write(SITE_INI.format(site=SITE, templates=templates))
+
+    # the tags queried by roxy.generators.blog are always among them
+    names = ['awesome', 'dude'] + ['tag-{}'.format(i)
+                                   for i in range(max(1, posts * tags // 100))]
+    today = datetime.utcnow()
+
+    def paragraphs(count):
+        return '\n\n'.join(' '.join(rand.choice(WORDS) for _ in range(60))
+                           for _ in range(count))
+
+    def extra():
+        lines = []
+        for i in range(properties):
+            if i % 2:
+                lines.append('prop_{}: {}'.format(i, rand.randint(0, 10000)))
+            else:
+                lines.append('prop_{}: {}'.format(i, rand.choice(WORDS)))
+        return lines
+
+    for i in range(posts):
+        date = today - timedelta(days=rand.randint(0, 730))
+        header = [
+            'type: post',
+            'date: {:%Y-%m-%d}'.format(date),
+            'title: Post {}'.format(i),
+            'slug: post-{}'.format(i),
+            'likes: {}'.format(rand.randint(0, 1000)),
+            'tags: ' + '\n      '.join(rand.sample(names, min(3, len(names)))),
+        ] + extra()
+        body = paragraphs(3)
+        if i:
+            body += '\n\nSee also [the previous post](post-{}:content).'.format(i - 1)
+        _write(os.path.join(content, 'post-{}.md'.format(i)), header, body)
+
+    for i in range(max(1, posts * pages // 100)):
+        header = [
+            'type: page',
+            'date: {:%Y-%m-%d}'.format(today),
+            'title: Page {}'.format(i),
+            'slug: page-{}'.format(i),
+        ] + extra()
+        _write(os.path.join(content, 'page-{}.md'.format(i)), header, paragraphs(5))
+
+    for i in range(posts * images // 100):
+        _image(os.path.join(assets, 'image-{}.jpg'.format(i)), rand)
+        header = [
+            'title: Image {}'.format(i),
+            'slug: image-{}'.format(i),
+        ]
+        _write(os.path.join(assets, 'image-{}.metadata'.format(i)), header,
+               paragraphs(1))
+
+
+def _write(path, header, body):
+    with open(path, 'wb') as f:
+        f.write('\n'.join(header))
+        f.write('\n\n')
+        f.write(body)
+        f.write('\n')
+
+
+def _image(path, rand, size=(1600, 1200)):
+    from PIL import Image
+    noise = Image.effect_noise(size, rand.randint(16, 96))
+    Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise)).\
+        save(path, 'JPEG', quality=90)
+
+
+def run(path):
+    """builds the site at `path` in a new process, returning its timings"""
+    # not a pool worker, which as a daemon couldn't start the image pool
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_process, args=(path, queue))
+    process.start()
+    try:
+        while True:
+            try:
+                ok, result = queue.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    raise RuntimeError("building {} exited with status {}".format(
+                        path, process.exitcode))
+    finally:
+        process.join()
+
+    if not ok:
+        raise RuntimeError("building {} failed\n{}".format(path, result))
+    return result
+
+
+def _run_process(path, queue):
+    try:
+        queue.put((True, _run(path)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+@contextmanager
+def _timed(timings, name):
+    start = time.time()
+    yield
+    timings[name] = time.time() - start
+
+
+def _run(path):
+    # the content store, previews and output are created from scratch
+    os.chdir(path)
+    for p in ('{}.content'.format(SITE), '{}.cache'.format(SITE), 'site'):
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.remove(p)
+
+    import roxy.configure as configure
+    import roxy.model as model
+    import roxy.profiler as profiler
+    import roxy.main as main
+    from roxy.model import Site
+
+    arguments = {
+        '<site>': SITE,
+        '--config': 'site.ini',
+        'initialize': True,
+        '--full': False,
+        '--jobs': None,
+    }
+    config = configure.configure(arguments)
+    main.logger = logging.getLogger('roxy')
+    session = model.get_session()
+    timings = {}
+
+    site = Site(slug=SITE, name=config['name'], url=config['url'])
+    session.add(site)
+    with _timed(timings, 'ingest_content'):
+        content = main.ingest_content(site, config)
+    with _timed(timings, 'ingest_assets'):
+        assets = main.ingest_assets(site, config)
+    with _timed(timings, 'commit'):
+        session.add_all(content)
+        session.add_all(assets)
+        session.commit()
+
+    with _timed(timings, 'ingest_content (unchanged)'):
+        main.ingest_content(site, config)
+    with _timed(timings, 'ingest_assets (unchanged)'):
+        main.ingest_assets(site, config)
+    session.commit()
+
+    threshold = datetime.now() - timedelta(days=30)
+    for name, query in QUERIES:
+        session.expire_all()
+        with _timed(timings, 'query: {}'.format(name)):
+            query(site, threshold)
+
+    # the build is profiled for the time and statements of each phase
+    report = os.path.join(path, 'profile.json')
+    with _timed(timings, 'generate'):
+        with profiler.profiling(session.get_bind(), report):
+            main.generate(arguments, config)
+
+    with open(report, 'rb') as f:
+        phases = json.load(f)['phases']
+    for name, phase in phases.items():
+        timings['generate: {}'.format(name)] = phase['seconds']
+
+    with _timed(timings, 'generate (unchanged)'):
+        main.generate(arguments, config)
+
+    statements = dict(('generate: {}'.format(k), v['statements'])
+                      for k, v in phases.items())
+    return dict(timings=timings, statements=statements)
+
+
+def report(results):
+    scales = sorted(results['scales'], key=int)
+    names = sorted(set(k for s in scales
+                       for k in results['scales'][s]['timings']))
+
+    width = max(len(n) for n in names)
+    lines = [' '.join(['{:<{}}'.format('', width)] +
+                      ['{:>10}'.format(s) for s in scales])]
+    for n in names:
+        row = ['{:<{}}'.format(n, width)]
+        for s in scales:
+            t = results['scales'][s]['timings'].get(n)
+            row.append('{:>10}'.format('-' if t is None else '{:.3f}'.format(t)))
+        lines.append(' '.join(row))
+
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def check_scaling(results, max_exponent, floor=0.01):
+    """
+    the operations whose time grows faster than n ** `max_exponent` between
+    consecutive scales, ignoring those which take less than `floor` seconds
+    """
+    regressions = []
+    scales = sorted(results['scales'], key=int)
+    for a, b in zip(scales, scales[1:]):
+        ta = results['scales'][a]['timings']
+        tb = results['scales'][b]['timings']
+        for name in sorted(set(ta) & set(tb)):
+            if ta[name] < floor or tb[name] < floor:
+                continue
+            exponent = math.log(tb[name] / ta[name]) / math.log(float(b) / int(a))
+            if exponent > max_exponent:
+                logger.warning("{} grows as n^{:.2f} from {} to {} posts".format(
+                    name, exponent, a, b))
+                regressions.append((name, a, b, exponent))
+
+    return regressions
+
+
+def compare(results, baseline, threshold, floor=0.01):
+    """
+    the operations more than `threshold` slower than the baseline, or which
+    issue more SQL statements, at any scale both have measured
+    """
+    regressions = []
+    for scale, current in sorted(results['scales'].items()):
+        previous = baseline['scales'].get(scale)
+        if previous is None:
+            continue
+
+        for name, t in sorted(current['timings'].items()):
+            before = previous['timings'].get(name)
+            if before is None or max(t, before) < floor:
+                continue
+            if t > before * (1 + threshold):
+                logger.warning("{} at {} posts took {:.3f}s, {:.3f}s in the baseline".format(
+                    name, scale, t, before))
+                regressions.append((name, scale, before, t))
+
+        for name, n in sorted(current['statements'].items()):
+            before = previous['statements'].get(name)
+            if before is not None and n > before:
+                logger.warning("{} at {} posts issued {} statements, {} in the baseline".format(
+                    name, scale, n, before))
+                regressions.append((name, scale, before, n))
+
+    if not regressions:
+        logger.info("no regressions from the baseline")
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,12 @@ import os
 import logging
 import logging.config
 import importlib
+import multiprocessing
 from ConfigParser import SafeConfigParser, NoSectionError
 
 from dateutil.tz import tzutc, gettz
 import sqlalchemy
-from jinja2 import FileSystemLoader, Environment
+from jinja2 import FileSystemLoader, FileSystemBytecodeCache, Environment
 
 import roxy.model as model
 import roxy.util as util
@@ -22,6 +23,15 @@ def _configure_list(config, *keys):
     return config
 
 
+def _configure_bool(config, key, default=False):
+    v = config.get(key)
+    if v is None:
+        config[key] = default
+    elif isinstance(v, basestring):
+        config[key] = v.strip().lower() in ('true', 'yes', 'on', '1')
+
+    return config
+
 
 def configure(arguments):
     global config
@@ -44,6 +54,20 @@ def configure(arguments):
     content_store = '{}.content'.format(site_name)
     dsn = 'sqlite:///{}/{}'.format(here, content_store)
     engine = sqlalchemy.create_engine(dsn, encoding='utf8')
+
+    # storage profile, sqlite's defaults unless configured
+    try:
+        sqlite = dict(parser.items('sqlite'))
+        sqlite.pop('here')
+    except NoSectionError:
+        sqlite = {}
+
+    pragmas = dict((k, sqlite.get(k) or None) for k in ('journal_mode', 'synchronous'))
+    if sqlite.get('cache_size'):
+        pragmas['cache_size'] = int(sqlite['cache_size']) * 2 ** 10
+    if sqlite.get('mmap_size'):
+        pragmas['mmap_size'] = int(sqlite['mmap_size']) * 2 ** 20
+    model.set_pragmas(engine, **pragmas)
     model.initialize(engine, create=arguments['initialize'])
     logger.info("using content store {}".format(content_store))
     logger.debug("dsn {}".format(dsn))
@@ -63,10 +87,51 @@ def configure(arguments):
     roxy.update(site)
     roxy['site'] = site_name
 
+    # ingestion in one transaction, without autoflush
+    _configure_bool(sqlite, 'bulk_load', default=True)
+    roxy['bulk_load'] = sqlite['bulk_load']
+
     # document_formats
     _configure_list(roxy, 'document_formats')
     roxy['document_formats'] = map(lambda s: s.lower(), roxy['document_formats'])
 
+    # ignored source files
+    if 'ignore' in roxy:
+        _configure_list(roxy, 'ignore')
+        roxy['ignore'] = filter(None, roxy['ignore'])
+    else:
+        roxy['ignore'] = []
+
+    # incremental ingestion, unless a full rebuild was requested
+    _configure_bool(roxy, 'incremental', default=True)
+    if arguments.get('--full'):
+        roxy['incremental'] = False
+
+    # render processes
+    roxy['jobs'] = int(arguments.get('--jobs') or roxy.get('jobs', 1))
+
+    # markdown extensions
+    if 'markdown_extensions' in roxy:
+        _configure_list(roxy, 'markdown_extensions')
+        roxy['markdown_extensions'] = filter(None, roxy['markdown_extensions'])
+    else:
+        roxy['markdown_extensions'] = []
+
+    # streaming writes
+    _configure_bool(roxy, 'streaming')
+    roxy['write_batch'] = int(roxy.get('write_batch') or 100)
+
+    # image workers
+    roxy['image_jobs'] = int(roxy.get('image_jobs') or multiprocessing.cpu_count())
+    roxy['image_worker_tasks'] = int(roxy.get('image_worker_tasks') or 0) or None
+    roxy['image_worker_memory'] = int(roxy.get('image_worker_memory') or 0) or None
+
+    # image derivative cache
+    if 'image_cache_path' not in roxy:
+        roxy['image_cache_path'] = os.path.join(here, '{}.cache'.format(site_name))
+    roxy['image_cache_size'] = int(roxy.get('image_cache_size') or 1024) * 2 ** 20
+    _configure_bool(roxy, 'link_copies')
+
     # timezone
     if 'timezone' in roxy:
         roxy['timezone'] = gettz(roxy['timezone'])
@@ -76,8 +141,22 @@ def configure(arguments):
     # renderer
     jinja2 = dict(parser.items('jinja2'))
     _configure_list(jinja2, 'filters')
+    _configure_bool(jinja2, 'auto_reload', default=True)
     loader = FileSystemLoader(roxy['template_path'])
-    env = Environment(loader=loader)
+    options = dict(loader=loader, auto_reload=jinja2['auto_reload'])
+
+    if 'cache_size' in jinja2:
+        options['cache_size'] = int(jinja2['cache_size'])
+
+    # compiled templates are kept between runs
+    if jinja2.get('bytecode_cache'):
+        path = jinja2['bytecode_cache']
+        if not os.path.exists(path):
+            os.makedirs(path)
+        options['bytecode_cache'] = FileSystemBytecodeCache(path)
+        logger.debug("using bytecode cache {}".format(path))
+
+    env = Environment(**options)
 
     for m in jinja2['filters']:
         m = importlib.import_module(m)
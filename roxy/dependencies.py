@@ -0,0 +1,224 @@
+import os
+import hashlib
+import logging
+from contextlib import contextmanager
+
+from jinja2 import TemplateNotFound, meta
+
+import roxy.util as util
+from roxy.model import Model, Content, Asset, Tag, Dependency, get_session
+
+
+logger = logging.getLogger('roxy')
+
+# dependencies recorded by the render in progress, see `tracking`
+_tracked = None
+
+# kinds of dependency which can be derived without rendering
+STATIC_KINDS = ('template', 'content', 'asset', 'tag', 'context')
+
+
+def digest(obj):
+    """a digest of `obj` which changes whenever its rendering could change"""
+    if isinstance(obj, Content):
+        if obj.checksum is None:
+            return None
+        return unicode(obj.checksum)
+
+    if isinstance(obj, Asset):
+        # an asset's metadata, such as its title, is kept beside it
+        if obj.checksum is None:
+            return None
+        return u'{}:{}'.format(obj.checksum, obj.metadata_checksum)
+
+    if isinstance(obj, Tag):
+        h = hashlib.sha1(obj.name.encode('utf8'))
+        for c in sorted(obj.content, key=lambda c: c.key):
+            h.update('{}:{}'.format(c.key, c.checksum))
+        return unicode(h.hexdigest())
+
+    return None
+
+
+def record(kind, ref, digest):
+    """record that the render in progress used `ref`"""
+    if _tracked is not None:
+        _tracked.add((kind, unicode(ref), digest))
+
+
+def record_model(obj):
+    if isinstance(obj, Model) and hasattr(obj, 'key'):
+        kind = obj.__class__.__name__.lower()
+        record(kind, obj.key, digest(obj))
+
+
+@contextmanager
+def tracking():
+    """collects the dependencies recorded while rendering"""
+    global _tracked
+    previous = _tracked
+    _tracked = set()
+    try:
+        yield _tracked
+    finally:
+        _tracked = previous
+
+
+def _context_repr(context):
+    """a canonical representation of `context`, with models reduced to their keys"""
+    if isinstance(context, Model):
+        return '<{} {}>'.format(context.__class__.__name__, getattr(context, 'key', None))
+    if isinstance(context, dict):
+        items = sorted((repr(k), _context_repr(v)) for k, v in context.items())
+        return '{{{}}}'.format(', '.join('{}: {}'.format(k, v) for k, v in items))
+    if isinstance(context, (list, tuple)):
+        return '[{}]'.format(', '.join(_context_repr(v) for v in context))
+    return repr(context)
+
+
+class DependencyGraph(object):
+    """
+    maps each output path to the models, templates and `route`/`fetch`
+    lookups it was rendered from
+    """
+    def __init__(self, config):
+        self.config = config
+        self.renderer = config['renderer']
+        self.graph = {}
+        self.updated = set()
+        self._template_digests = {}
+
+    def load(self):
+        for d in Dependency.query.all():
+            self.graph.setdefault(d.path, set()).add((d.kind, d.ref, d.digest))
+        logger.debug("loaded dependencies of {} outputs".format(len(self.graph)))
+        return self
+
+    def save(self, live_paths=None):
+        session = get_session()
+        stale = set(self.updated)
+        if live_paths is not None:
+            dead = set(self.graph) - set(live_paths)
+            for path in dead:
+                del self.graph[path]
+            stale |= dead
+
+        stale = list(stale)
+        for i in range(0, len(stale), 500):
+            Dependency.query.\
+                filter(Dependency.path.in_(stale[i:i + 500])).\
+                delete(synchronize_session=False)
+
+        for path in self.updated:
+            for kind, ref, d in self.graph.get(path, ()):
+                session.add(Dependency(path=path, kind=kind, ref=ref, digest=d))
+
+        self.updated = set()
+
+    def invalidate_templates(self):
+        """forgets the digests of templates, which may have changed"""
+        self._template_digests = {}
+
+    def update(self, path, dependencies):
+        self.graph[path] = set(dependencies)
+        self.updated.add(path)
+
+    def is_current(self, path, template, fallback, context):
+        """true if `path` exists and none of its inputs have changed"""
+        stored = self.graph.get(path)
+        if not stored:
+            return False
+
+        if not os.path.exists(util.output_path(self.config['build_path'], path)):
+            return False
+
+        static = self.static_dependencies(template, fallback, context)
+        if any(d is None for _, _, d in static):
+            return False
+
+        if static != set(d for d in stored if d[0] in STATIC_KINDS):
+            return False
+
+        for kind, ref, d in stored:
+            if kind in STATIC_KINDS:
+                continue
+            if d is None or d != self.resolve(kind, ref):
+                return False
+
+        return True
+
+    def static_dependencies(self, template, fallback, context):
+        """the dependencies of a render job which are known before rendering"""
+        deps = set()
+        with tracking() as tracked:
+            self._record_templates(template, fallback)
+            self._record_context(context)
+            if not isinstance(context, Model):
+                # values a generator computed, such as counts or dates
+                h = hashlib.sha1(_context_repr(context))
+                record('context', '', unicode(h.hexdigest()))
+            deps |= tracked
+        return deps
+
+    def resolve(self, kind, ref):
+        """the current digest of a `route` or `fetch` dependency"""
+        filters = self.renderer.filters
+        try:
+            with tracking():
+                if kind == 'route':
+                    return unicode(filters['route'](ref))
+                if kind == 'fetch':
+                    cls_, key = ref.split(':', 1)
+                    return digest(filters['fetch'](key, cls_=cls_ or None))
+        except KeyError:
+            return None
+
+        return None
+
+    def _record_context(self, context):
+        if isinstance(context, Model):
+            record_model(context)
+        elif isinstance(context, dict):
+            for v in context.values():
+                self._record_context(v)
+        elif isinstance(context, (list, tuple)):
+            for v in context:
+                self._record_context(v)
+
+    def _record_templates(self, template, fallback):
+        try:
+            self.renderer.loader.get_source(self.renderer, template)
+        except TemplateNotFound:
+            if fallback:
+                template = fallback
+
+        seen = set()
+        pending = [template]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+
+            d, parents = self._template_digest(name)
+            record('template', name, d)
+            pending.extend(parents)
+
+    def _template_digest(self, name):
+        if name not in self._template_digests:
+            env = self.renderer
+            try:
+                source, _, _ = env.loader.get_source(env, name)
+            except TemplateNotFound:
+                self._template_digests[name] = None, []
+            else:
+                h = hashlib.sha1(source.encode('utf8'))
+                parents = list(meta.find_referenced_templates(env.parse(source)))
+                if None in parents:
+                    # a dynamic extends/include can't be tracked, so the
+                    # output has to be rendered every time
+                    self._template_digests[name] = None, [p for p in parents if p]
+                else:
+                    self._template_digests[name] = unicode(h.hexdigest()), parents
+
+        return self._template_digests[name]
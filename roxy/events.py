@@ -1,12 +1,22 @@
+import time
 import logging
 
 logger = logging.getLogger('roxy')
 
+# every event, for `stats` and `reset`
+_events = []
+
+
+def _name(f):
+    return '.'.join([f.__module__, f.__name__])
+
 
 class Event(object):
     def __init__(self, name):
         self.name = name
         self.subscribers = []
+        self.reset()
+        _events.append(self)
 
     def subscribe(self, subscriber):
         self.subscribers.append(subscriber)
@@ -16,18 +26,68 @@ class Event(object):
         if self.subscribers:
             logger.debug('firing {!r}'.format(self))
 
+        self.fired += 1
         for s in self.subscribers:
+            start = time.time()
             result = s(*args, **kwargs)
+            self._record(s, time.time() - start, result is False)
             if result is False:
+                logger.debug('{} stopped {}'.format(_name(s), self.name))
                 break
 
+    def _record(self, subscriber, seconds, stopped):
+        name = _name(subscriber)
+        if name not in self.timings:
+            self.timings[name] = dict(calls=0, seconds=0.0, max=0.0, stopped=0)
+        t = self.timings[name]
+        t['calls'] += 1
+        t['seconds'] += seconds
+        t['max'] = max(t['max'], seconds)
+        if stopped:
+            t['stopped'] += 1
+            self.stopped_by = name
+
+    def stats(self):
+        """
+        the number of times fired, the calls, total and maximum time of each
+        subscriber and the number of times it stopped the event, and the last
+        subscriber to stop the event, if any
+        """
+        return {
+            'fired': self.fired,
+            'subscribers': dict((k, dict(v)) for k, v in self.timings.items()),
+            'stopped_by': self.stopped_by,
+        }
+
+    def reset(self):
+        self.fired = 0
+        self.timings = {}
+        self.stopped_by = None
+
     def __unicode__(self):
-        s = ['.'.join([f.__module__, f.__name__]) for f in self.subscribers]
+        s = [_name(f) for f in self.subscribers]
         return "<Event: {}, subscribers=[{}]>".format(self.name, ', '.join(s))
 
     __repr__ = __unicode__
     __str__ = __unicode__
 
+
+def stats():
+    """the stats of every event which has fired, by name"""
+    return dict((e.name, e.stats()) for e in _events if e.fired)
+
+
+def reset():
+    for e in _events:
+        e.reset()
+
+
+def slowest(n=10):
+    """the `n` subscribers with the most total time, as (event, name, stats)"""
+    timings = [(e.name, name, t) for e in _events for name, t in e.timings.items()]
+    timings.sort(key=lambda x: x[2]['seconds'], reverse=True)
+    return timings[:n]
+
 BeforeIngest = Event('BeforeIngest')
 BeforeGenerate = Event('BeforeGenerate')
 BeforeRoute = Event('BeforeRoute')
@@ -1,14 +1,14 @@
 # vim: set fileencoding=utf8 :
 import os
 import logging
-import tempfile
+from functools import wraps
 
-from PIL import ImageOps, Image
-
-from roxy.events import BeforeRoute, AfterWrite, BeforeRender
-from roxy.model import Model, get_session
+from roxy.events import BeforeGenerate, BeforeRoute, AfterWrite, BeforeRender
+from roxy.model import Model, get_session, eager_loading
 import roxy.util as util
 import roxy.configure as configure
+import roxy.profiler as profiler
+import roxy.assets.image as image
 
 
 def model_dict(model, defaults):
@@ -17,7 +17,8 @@ def model_dict(model, defaults):
     else:
         values = {}
 
-    values.update(model.as_dict())
+    # formatting paths and templates never needs deferred columns
+    values.update(model.as_dict(include_deferred=False))
     return values
 
 
@@ -26,8 +27,12 @@ def render(path_fmt, defaults=None):
     logger = logging.getLogger('roxy')
     def render(fn):
         logger.debug('render {}'.format(path_fmt))
+        @wraps(fn)
         def queued_render(*args, **kwargs):
-            templates = fn(*args, **kwargs)
+            # every result will be rendered, so its tags and properties are
+            # needed anyway
+            with eager_loading():
+                templates = fn(*args, **kwargs)
             render = []
             for t in templates:
                 template, fallback, context = t
@@ -49,9 +54,11 @@ def using(template_fmt, fallback_fmt=None, defaults=None):
     logger = logging.getLogger('roxy')
     def using(fn):
         logger.debug('using {}, {}'.format(template_fmt, fallback_fmt))
+        @wraps(fn)
         def template(*args, **kwargs):
             logger.debug('templating {}'.format(fn.__name__))
-            context = fn(*args, **kwargs)
+            with eager_loading():
+                context = fn(*args, **kwargs)
             templates = []
 
             if not isinstance(context, list):
@@ -75,10 +82,36 @@ def using(template_fmt, fallback_fmt=None, defaults=None):
 _render_queue = []
 def enqueue_render(f):
     _render_queue.append(f)
+    invalidate_render_queue()
+
+
+_render_jobs = None
+def evaluate_render_queue(site):
+    """
+    the render jobs of every queued generator, evaluated once and shared by
+    the route and render phases until `invalidate_render_queue` is called
+    """
+    global _render_jobs
+    if _render_jobs is None:
+        renders = []
+        with profiler.phase('generate'):
+            for r in _render_queue:
+                with profiler.timed('generator', r.__name__):
+                    renders.extend(r(site))
+        _render_jobs = renders
+
+    return _render_jobs
+
+
+@BeforeGenerate.subscribe
+def invalidate_render_queue(*args, **kwargs):
+    global _render_jobs
+    _render_jobs = None
 
 
 def copy(template_fmt, fallback_fmt=None, defaults=None):
     def copy(fn):
+        @wraps(fn)
         def queued_copy(*args, **kwargs):
             config = configure.current_config()
             jobs = fn(*args, **kwargs)
@@ -102,34 +135,48 @@ def copy(template_fmt, fallback_fmt=None, defaults=None):
 
 
 def image_fit(fmt, **sizes):
+    logger = logging.getLogger('roxy')
     def fit(fn):
+        @wraps(fn)
         def fit(*args, **kwargs):
+            with profiler.phase('images'), profiler.timed('image', fn.__name__):
+                return _fit(*args, **kwargs)
+
+        def _fit(*args, **kwargs):
             config = configure.current_config()
             assets = fn(*args, **kwargs)
-            contexts = []
+            cache = image.get_cache(config)
+            extension = fmt.lower()
+            pending = []
             for asset in assets:
+                source = os.path.join(config['asset_source_path'], asset.path)
                 for size, params in sizes.items():
-                    path = os.path.join(config['asset_source_path'], asset.path)
-                    image = Image.open(path)
-
-                    bounds = [min(image.size[i], params[i]) for i in range(2)]
-                    preview = ImageOps.fit(image, bounds, method=Image.ANTIALIAS)
                     values = {
                         'filename': asset.filename,
                         'size': size,
-                        'extension': fmt.lower()
+                        'extension': extension
                     }
 
-                    _, path = tempfile.mkstemp(suffix='.'+fmt.lower())
-
-                    def setter(path, size=size):
+                    def setter(path, size=size, asset=asset):
                         setattr(asset, size, path)
                         session = get_session()
                         session.add(asset)
 
-                    with open(path, 'rb') as f:
-                        preview.save(path, format=fmt)
-                        contexts.append((path, values, setter))
+                    # previews are cached by the source and how it was fit
+                    key = cache.key(asset.digest, tuple(params), fmt, 'fit',
+                                    'antialias', 'clamp')
+                    path, result = image.derive(config, key, extension, image.fit,
+                                                source, params, fmt, clamp=True)
+                    if result is None:
+                        logger.debug("cached {} {}".format(asset.path, size))
+                    pending.append((result, path, values, setter))
+
+            # wait for the workers, setters are applied by the caller
+            contexts = []
+            for result, path, values, setter in pending:
+                if result is not None:
+                    result.get()
+                contexts.append((path, values, setter))
 
             return contexts
         return fit
@@ -143,10 +190,7 @@ def enqueue_copy_job(f):
 
 @BeforeRoute.subscribe
 def get_routes(site, config, route_mappings):
-    renders = []
-    for r in _render_queue:
-        renders.extend(r(site))
-
+    renders = evaluate_render_queue(site)
     route_mappings.update({
         path: context for path, _, _, context in renders 
         if isinstance(context, Model)
@@ -157,19 +201,17 @@ def get_routes(site, config, route_mappings):
 def process_copy_jobs(site, config, write_list):
     logger = logging.getLogger('roxy')
     config = configure.current_config()
-    for j in _copy_queue:
-        for src, dest in j(site):
-            logger.info("copying {} ▶ {}".format(src, dest))
-            util.copy(src, (config['build_path'], dest))
+    with profiler.phase('copy'):
+        for j in _copy_queue:
+            with profiler.timed('copy', j.__name__):
+                for src, dest in j(site):
+                    logger.info("copying {} ▶ {}".format(src, dest))
+                    util.copy(src, (config['build_path'], dest), link=config['link_copies'])
 
 
 @BeforeRender.subscribe
 def get_render_jobs(site, config, render_list):
-    renders = []
-    for r in _render_queue:
-        renders.extend(r(site))
-
-    render_list.extend(renders)
+    render_list.extend(evaluate_render_queue(site))
 
 
 @AfterWrite.subscribe
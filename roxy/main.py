@@ -2,8 +2,11 @@
 Generate the site
 
 Usage:
-    roxy [--config=INI] generate <site> [--file=FILE]
+    roxy [--config=INI] generate <site> [--file=FILE] [--full] [--jobs=N]
+                                [--profile=REPORT] [--pstats=FILE]
     roxy [--config=INI] initialize <site> [--file=FILE]
+    roxy [--config=INI] precompile <site> [--file=FILE]
+    roxy [--config=INI] watch <site> [--file=FILE] [--jobs=N] [--port=PORT]
     roxy [--config=INI] shell <site> [--file=FILE]
     roxy (-h | --help)
 
@@ -11,24 +14,38 @@ Options:
     -h, --help              Show this text
     -c INI, --config=INI    Config path [default: site.ini]
     -f FILE, --file=FILE    Content store, defaults to <site>.content
+    --full                  Re-ingest every file, even if it is unchanged
+    -j N, --jobs=N          Render with N processes
+    -p PORT, --port=PORT    Port to serve the site on while watching [default: 8000]
+    --profile=REPORT        Write a JSON report of the time and SQL statements
+                            spent in each phase of the build
+    --pstats=FILE           Write a cProfile dump of the build
 """
 import os
 import sys
 import logging
 import mimetypes
 import importlib
+import multiprocessing
 import code
+from itertools import izip
+from collections import namedtuple
 from datetime import datetime
 from dateutil.tz import tzutc
 
 from docopt import docopt
-from jinja2 import TemplateNotFound
+from jinja2 import TemplateNotFound, TemplateSyntaxError, TemplateError
 from markdown import Markdown
-from BeautifulSoup import BeautifulSoup
 
 import roxy.model as model
 import roxy.configure as configure
 import roxy.util as util
+import roxy.dependencies as dependencies
+import roxy.manifest as manifest
+import roxy.markup as markup
+import roxy.profiler as profiler
+import roxy.events as events
+import roxy.watch as watch
 import roxy.generators
 from roxy.model import Model, Site, Content, Asset, Tag, Property
 from roxy.events import BeforeRender, BeforeIngest, BeforeRoute, BeforeRender,\
@@ -49,7 +66,17 @@ def main(argv=sys.argv):
 
     try:
         if arguments['generate']:
-            generate(arguments, config)
+            engine = model.get_session().get_bind()
+            with profiler.profiling(engine, arguments['--profile'],
+                                    arguments['--pstats']):
+                generate(arguments, config)
+
+        if arguments['watch']:
+            watch.watch(arguments, config, generate)
+
+        if arguments['precompile']:
+            if precompile(config):
+                sys.exit(1)
 
         if arguments['shell']:
             l = {
@@ -59,7 +86,9 @@ def main(argv=sys.argv):
                 'Content': Content,
                 'Asset': Asset,
                 'Tag': Tag,
-                'Property': Property
+                'Property': Property,
+                'events': events,
+                'generate': lambda: generate(arguments, config)
             }
             code.interact(local=l)
 
@@ -72,8 +101,59 @@ def main(argv=sys.argv):
         pdb.post_mortem(sys.exc_info()[2])
 
 
-def generate(arguments, config):
+def precompile(config):
+    """compiles every template, returning the number which failed"""
+    env = config['renderer']
+    if env.bytecode_cache is None:
+        logger.warning("no bytecode_cache is configured, only checking syntax")
+
+    errors = 0
+    names = env.list_templates()
+    for name in names:
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors += 1
+            logger.error("{}:{}: {}".format(e.filename or name, e.lineno, e.message))
+        except (TemplateError, UnicodeDecodeError) as e:
+            # e.g. an editor's swap or backup file beside the templates
+            errors += 1
+            logger.error("{}: {}".format(name, e))
+
+    logger.info("compiled {} templates, {} failed".format(len(names) - errors, errors))
+    return errors
+
+
+class BuildState(object):
+    """
+    what a build loads from the content store, which the next build in the
+    same process reuses rather than loading again, see `roxy watch`; only
+    valid while the session doesn't expire objects on commit
+    """
+    def __init__(self):
+        self.content = None
+        self.assets = None
+        self.index = None
+        self.render_cache = None
+        self.graph = None
+        self.outputs = None
+
+    @property
+    def warm(self):
+        return self.content is not None
+
+
+def generate(arguments, config, state=None, changed=None):
+    """
+    builds the site, returning its `BuildState`; given the state of a
+    previous build, only the `changed` source paths are ingested, and what
+    it loaded is reused
+    """
     session = model.get_session()
+    if state is None:
+        state = BuildState()
+    if not state.warm:
+        changed = None
 
     # find site or create if doesn't exist
     site = Site.get(slug=config['site'])
@@ -81,72 +161,285 @@ def generate(arguments, config):
         site = Site(slug=config['site'], name=config['name'], url=config['url'])
         session.add(site)
 
-    # for all content encountered
-    BeforeIngest.fire(site, config)
+    # subscriber stats are kept for the latest build
+    events.reset()
 
-    content = ingest_content(site, config)
-    assets = ingest_assets(site, config)
+    # tags are loaded once per build, or kept from the previous one
+    tags = model.get_tag_registry()
+    if not state.warm:
+        tags.invalidate()
 
-    AfterIngest.fire(site, config, content=content, assets=assets)
+    # for all content encountered
+    with profiler.phase('ingest'), model.recording_changes() as (touched, removed):
+        if config['bulk_load']:
+            with model.bulk_load():
+                content, assets = ingest(site, config, state, changed)
+        else:
+            content, assets = ingest(site, config, state, changed)
+            session.commit()
 
-    session.add_all(content)
-    session.add_all(assets)
-    session.commit()
+    # reload with the keys of tags created during ingestion
+    if not state.warm:
+        tags.invalidate()
+    state.content = {c.path: c for c in content}
+    state.assets = {a.path: a for a in assets}
 
 
     # import module which generates site
-    BeforeGenerate.fire(site, config)
-    generator = importlib.import_module(config['generator'])
-    AfterGenerate.fire(site, config, generator)
+    with profiler.phase('import'):
+        BeforeGenerate.fire(site, config)
+        generator = importlib.import_module(config['generator'])
+        AfterGenerate.fire(site, config, generator)
 
     # iterate over routes
     route_mappings = {}
 
-    BeforeRoute.fire(site, config, route_mappings)
-    # route_mappings.update({path: context for path, _, _, context in write_list if isinstance(context, Model)})
-    route_mappings.update({a.path: a for a in assets})
+    with profiler.phase('route'):
+        BeforeRoute.fire(site, config, route_mappings)
+        # route_mappings.update({path: context for path, _, _, context in write_list if isinstance(context, Model)})
+        route_mappings.update({a.path: a for a in assets})
 
-    config['renderer'].filters['route'] = make_router(config, route_mappings)
-    config['renderer'].filters['fetch'] = make_fetcher(config, route_mappings)
-    config['renderer'].filters['render'] = make_renderer(config)
-    AfterRoute.fire(site, config, route_mappings)
+        if state.render_cache is None:
+            state.render_cache = make_render_cache(config)
+        else:
+            state.render_cache.reset()
+        if state.index is None:
+            state.index = model.IdentityIndex(site)
+        else:
+            state.index.update(touched.values(), removed.values())
+        render_cache = state.render_cache
+        install_filters(config, route_mappings, state.index, render_cache)
+        AfterRoute.fire(site, config, route_mappings)
 
     # render the documents
-    write_list = []
     render_list = []
-    BeforeRender.fire(site, config, render_list)
+    with profiler.phase('render'):
+        BeforeRender.fire(site, config, render_list)
+
+    with profiler.phase('dependencies'):
+        if state.graph is None:
+            state.graph = dependencies.DependencyGraph(config).load()
+            state.outputs = manifest.Manifest(config).load()
+        elif changed is None or _beneath(changed, config['template_path']):
+            state.graph.invalidate_templates()
+        graph = state.graph
+        outputs = state.outputs
+        outputs.reset()
+        jobs = []
+        for path, template, fallback, context in render_list:
+            if config['incremental'] and\
+                    graph.is_current(path, template, fallback, context):
+                logger.debug("skipping {}, its inputs are unchanged".format(path))
+                continue
+            jobs.append((path, template, fallback, context))
+
+    if config['jobs'] > 1 and len(jobs) > 1:
+        results = render_parallel(arguments, config, route_mappings, jobs,
+                                  render_cache)
+    else:
+        results = (render_job(site, config, *j, stream=config['streaming'])
+                   for j in jobs)
+
+    # unless streaming, everything is rendered before anything is written
+    batch_size = config['write_batch'] if config['streaming'] else None
+    write_list = []
+    rendered = []
+    with profiler.phase('render'):
+        for job, (values, s, tracked) in izip(jobs, results):
+            path, template, fallback, context = job
+            AfterRender.fire(site, values, path, template, fallback, content, s)
+            write_list.append((path, s))
+            rendered.append((job, tracked))
 
-    for path, template, fallback, context in render_list:
-        values = {}
+            if batch_size and len(write_list) >= batch_size:
+                write_outputs(site, config, outputs, write_list)
+                update_dependencies(graph, rendered)
+                write_list, rendered = [], []
 
-        if isinstance(context, Model):
-            params = dict(site=site)
-            params.update(values)
-            keyname = context.__class__.__name__.lower()
-            params[keyname] = context
-            context = make_context(config, **params)
-        else:
-            values.update(context)
-            context = make_context(config, site=site, **values)
+    write_outputs(site, config, outputs, write_list)
+    update_dependencies(graph, rendered)
 
-        Render.fire(site, path, template, fallback, context)
+    live_paths = [path for path, _, _, _ in render_list]
+    with profiler.phase('write'):
+        graph.save(live_paths=live_paths)
+        outputs.prune(live_paths)
+        # only a build which rendered everything has used every rendering
+        # which is still needed
+        if len(jobs) == len(render_list):
+            render_cache.prune()
+        session.commit()
+    outputs.report()
 
-        logger.info("rendering {} via {}".format(path, template))
-        s = render(config['renderer'], template, fallback, context)
-        AfterRender.fire(site, values, path, template, fallback, content, s)
-        write_list.append((path, s))
+    for event, name, t in events.slowest(5):
+        logger.debug("{} on {}: {} calls, {:.3f}s".format(
+            name, event, t['calls'], t['seconds']))
+
+    return state
+
+
+def _beneath(paths, root):
+    return any(p == root or p.startswith(root + os.sep) for p in paths)
+
+
+def ingest(site, config, state, changed=None):
+    BeforeIngest.fire(site, config)
 
+    content = ingest_content(site, config, changed=changed, existing=state.content)
+    assets = ingest_assets(site, config, changed=changed, existing=state.assets)
+
+    AfterIngest.fire(site, config, content=content, assets=assets)
+
+    session = model.get_session()
+    session.add_all(content)
+    session.add_all(assets)
+    return content, assets
+
+
+def write_outputs(site, config, outputs, write_list):
     # process the write list
-    BeforeWrite.fire(site, config, write_list)
+    with profiler.phase('write'):
+        BeforeWrite.fire(site, config, write_list)
+
+        for path, s in write_list:
+            outputs.write(path, s)
+
+        AfterWrite.fire(site, config, write_list)
+
+
+def update_dependencies(graph, rendered):
+    # a streamed document's lookups are only known once it has been written
+    with profiler.phase('dependencies'):
+        for (path, template, fallback, context), tracked in rendered:
+            static = graph.static_dependencies(template, fallback, context)
+            graph.update(path, static | tracked)
+
+
+def install_filters(config, route_mappings, index, render_cache):
+    config['renderer'].filters['route'] = make_router(config, route_mappings)
+    config['renderer'].filters['fetch'] = make_fetcher(config, route_mappings, index)
+    config['renderer'].filters['render'] = make_renderer(config, render_cache)
+
+
+def render_job(site, config, path, template, fallback, context, stream=False):
+    values = {}
+
+    if isinstance(context, Model):
+        params = dict(site=site)
+        params.update(values)
+        keyname = context.__class__.__name__.lower()
+        params[keyname] = context
+        context = make_context(config, **params)
+    else:
+        values.update(context)
+        context = make_context(config, site=site, **values)
+
+    Render.fire(site, path, template, fallback, context)
+
+    logger.info("rendering {} via {}".format(path, template))
+    if stream:
+        tracked = set()
+        s = render(config['renderer'], template, fallback, context, stream=True)
+        return values, _tracked_stream(s, tracked), tracked
+
+    with dependencies.tracking() as tracked, profiler.timed('template', template):
+        s = render(config['renderer'], template, fallback, context)
+
+    return values, s, tracked
+
 
-    for path, s in write_list:
-        if path.startswith('/'):
-            path = path[1:]
-        path = os.path.join(config['build_path'], path)
-        logger.info("writing {}".format(path))
-        util.write(path, s)
+def _tracked_stream(stream, tracked):
+    # records into `tracked` as the stream is consumed
+    with dependencies.tracking() as t:
+        for chunk in stream:
+            yield chunk
+    tracked.update(t)
 
-    AfterWrite.fire(site, config, write_list)
+
+def render_parallel(arguments, config, route_mappings, jobs, render_cache):
+    """
+    renders `jobs` over a pool of `config['jobs']` processes, yielding results
+    in the order of `jobs`
+    """
+    # workers read from their own sessions, so they must see everything the
+    # copy jobs have changed so far
+    model.get_session().commit()
+
+    processes = min(config['jobs'], len(jobs))
+    routes = {path: _reference(c) for path, c in route_mappings.items()}
+    work = [(path, template, fallback, _reference(context))
+            for path, template, fallback, context in jobs]
+    chunksize = max(1, len(work) // (processes * 4))
+    logger.info("rendering {} documents with {} processes".format(len(work), processes))
+
+    pool = multiprocessing.Pool(processes, _init_render_worker, (arguments, routes))
+    try:
+        results = pool.imap(_render_worker, work, chunksize)
+        for (_, _, _, context), (s, tracked, renderings) in izip(jobs, results):
+            # workers don't write to the content store
+            render_cache.absorb(renderings)
+            values = {} if isinstance(context, Model) else dict(context)
+            yield values, s, tracked
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _reference(context):
+    """replaces models in `context` with references a worker can resolve"""
+    if isinstance(context, Model):
+        return _ModelReference(context.__class__.__name__, context.key)
+    if isinstance(context, dict):
+        return {k: _reference(v) for k, v in context.items()}
+    if isinstance(context, (list, tuple)):
+        return [_reference(v) for v in context]
+    return context
+
+
+def _dereference(context, site, index):
+    """
+    replaces references in `context` with models from `index`, which loads
+    each class with one query rather than one per reference
+    """
+    if isinstance(context, _ModelReference):
+        if context.cls == Site.__name__ and context.key == site.key:
+            return site
+        return index.get(context.cls, context.key)
+    if isinstance(context, dict):
+        return {k: _dereference(v, site, index) for k, v in context.items()}
+    if isinstance(context, list):
+        return [_dereference(v, site, index) for v in context]
+    return context
+
+
+_ModelReference = namedtuple('_ModelReference', 'cls key')
+_worker = None
+
+
+def _init_render_worker(arguments, routes):
+    global logger, _worker
+
+    # a fresh configuration gives the worker its own Environment and session
+    config = configure.configure(arguments)
+    logger = logging.getLogger('roxy')
+    importlib.import_module(config['generator'])
+
+    site = Site.get(slug=config['site'])
+    index = model.IdentityIndex(site)
+    route_mappings = {path: _dereference(r, site, index) for path, r in routes.items()}
+    render_cache = make_render_cache(config, persist=False)
+    install_filters(config, route_mappings, index, render_cache)
+    _worker = site, config, render_cache, index
+
+
+def _render_worker(job):
+    site, config, render_cache, index = _worker
+    path, template, fallback, context = job
+    _, s, tracked = render_job(site, config, path, template, fallback,
+                               _dereference(context, site, index))
+    return s, tracked, render_cache.drain()
 
 
 def make_context(config, **kwargs):
@@ -156,7 +449,7 @@ def make_context(config, **kwargs):
     return values
 
 
-def make_fetcher(config, mappings):
+def make_fetcher(config, mappings, index):
     objects_by_key = {}
     objects_by_slug = {}
 
@@ -169,23 +462,16 @@ def make_fetcher(config, mappings):
 
     def fetcher(key, cls_=None):
         if cls_ is None:
-            if key in objects_by_key:
-                return objects_by_key[key]
-
-            if key in objects_by_slug:
-                return objects_by_slug[key]
+            obj = objects_by_key.get(key) or objects_by_slug.get(key)
+            if obj is not None:
+                ref = ':{}'.format(key)
+                dependencies.record('fetch', ref, dependencies.digest(obj))
+                return obj
         else:
-            classes = {
-                'content': Content,
-                'asset': Asset,
-                'tag': Tag
-            }
-            if cls_.lower() in classes:
-                cls = classes[cls_]
-                by_key = cls.get(key)
-                by_slug = cls.get(slug=key)
-                if by_key is not None or by_slug is not None:
-                    return by_key or by_slug
+            obj = index.get(cls_, key)
+            ref = '{}:{}'.format(cls_, key)
+            dependencies.record('fetch', ref, dependencies.digest(obj))
+            return obj
 
         raise KeyError(key)
 
@@ -218,6 +504,11 @@ def make_router(config, mappings):
             p = routes_by_slug[target]
 
         if p:
+            if isinstance(target, Model):
+                dependencies.record('route', target.key, p)
+            else:
+                dependencies.record('route', target, p)
+
             if absolute:
                 base = config['url_base']
                 return util.url_join(base, p)
@@ -229,56 +520,56 @@ def make_router(config, mappings):
     return router
 
 
-_md_renderer = None
-def make_renderer(config):
-    global _md_renderer
-    if not _md_renderer:
-        _md_renderer = Markdown()
+def make_renderer(config, cache):
     route = config['renderer'].filters['route']
     fetch = config['renderer'].filters['fetch']
+    references = []
+
+    def dereference(attr):
+        id, ref = attr.split(':', 1)
+        if '.' in ref:
+            ref, field = ref.split('.', 1)
+            obj = fetch(id, cls_=ref)
+            return getattr(obj, field)
+        else:
+            return route(id)
 
-    def render_filter(s):
-        md = _md_renderer.convert(s)
-        soup = BeautifulSoup(md)
-
-        def is_ref(attr):
-            return attr is not None and ':' in attr
-
-        def dereference(attr):
-            id, ref = attr.split(':', 1)
-            if '.' in ref:
-                ref, field = ref.split('.', 1)
-                obj = fetch(id, cls_=ref)
-                return getattr(obj, field)
-            else:
-                return route(id)
-
-        def replace_attrs(el, attr, callback):
-            for e in soup.findAll(el, attrs={attr: is_ref}):
-                a = e.get(attr)
-                value = dereference(a)
-                callback(e, attr, value)
+    def resolve(tag, attr, ref):
+        value = dereference(ref)
+        references.append((ref, value))
+        if (tag, attr) == ('img', 'src'):
+            return util.url_join(config['url_base'], value)
+        return unicode(value)
 
-        replace_attrs('a', 'href', _set_attr)
-        replace_attrs('a', 'title', _set_attr)
-        replace_attrs('img', 'src', _set_absolute_url)
-        replace_attrs('img', 'alt', _set_attr)
+    extensions = [markup.ReferenceExtension(resolve)]
+    extensions.extend(config['markdown_extensions'])
+    md_renderer = Markdown(extensions=extensions)
 
-        return unicode(soup)
+    def render_filter(s):
+        if not s:
+            return u''
 
-    def _set_absolute_url(el, key, path):
-        url = util.url_join(config['url_base'], path)
-        _set_attr(el, key, url)
+        key = cache.key(s)
+        html = cache.get(key, dereference)
+        if html is not None:
+            return html
 
-    def _set_attr(el, key, value):
-        for i, (k, v) in enumerate(el.attrs):
-            if k.lower() == key.lower():
-                el.attrs[i] = (k, value)
+        del references[:]
+        md_renderer.reset()
+        html = md_renderer.convert(s)
+        cache.put(key, html, references)
+        return html
 
     return render_filter
 
 
-def render(renderer, template, fallback, context):
+def make_render_cache(config, persist=True):
+    # anything which changes the HTML produced for the same markdown
+    settings = ('markdown', 3, sorted(config['markdown_extensions']), config['url_base'])
+    return markup.RenderCache(settings, persist=persist)
+
+
+def render(renderer, template, fallback, context, stream=False):
     try:
         template = renderer.get_template(template)
     except TemplateNotFound:
@@ -287,16 +578,34 @@ def render(renderer, template, fallback, context):
         else:
             raise
 
+    if stream:
+        return template.generate(context)
     return template.render(context)
 
 
-def ingest_assets(site, config):
+def ingest_assets(site, config, changed=None, existing=None):
+    """
+    the assets of `site`, updated from `asset_source_path`; just the
+    `changed` paths are read when given, the rest are taken from `existing`
+    """
     # for each file encountered in asset directory
-    asset_files = discover_assets(config['asset_source_path'])
+    ignore = config['ignore'] + ['*.metadata']
+    if changed is not None:
+        # an asset is re-ingested when its metadata changes
+        changed = set(changed) | set(_metadata_owners(changed))
+    asset_files, missing = _source_files(config['asset_source_path'], changed,
+                                         ignore=ignore)
     assets = []
 
+    # every existing asset is loaded at once, rather than queried per file
+    if existing is None:
+        existing = {a.path: a for a in site._assets}
+    else:
+        existing = dict(existing)
+    counts = dict(new=0, updated=0, unchanged=0)
+
     processors = []
-    for path in asset_files:
+    for path, size, mtime in asset_files:
         relative_path = os.path.relpath(path, config['asset_source_path'])
         m = mimetypes.guess_type(path)
         if m:
@@ -304,97 +613,202 @@ def ingest_assets(site, config):
         else:
             raise NotImplementedError(m)
 
+        a = existing.pop(relative_path, None)
+
         # search for metadata
         mdpath = '{}.metadata'.format(*os.path.splitext(path))
         if os.path.exists(mdpath):
             with open(mdpath, 'rb') as md:
                 document = md.read()
-                header, body = _parse_content_header(document)
-                metadata = _parse_metadata(header, config)
+                metadata_checksum = util.checksum(md)
+        else:
+            document = None
+            metadata_checksum = None
+
+        if config['incremental'] and a is not None and\
+                a.metadata_checksum == metadata_checksum:
+            # stat unchanged, assume contents are too
+            if (a.size, a.mtime) == (size, mtime):
+                logger.debug("unchanged {}".format(relative_path))
+                counts['unchanged'] += 1
+                assets.append(a)
+                continue
+
+            # stat changed but contents did not, e.g. a touched file
+            with open(path, 'rb') as f:
+                digest = util.digest(f)
+
+            if a.digest == digest:
+                logger.debug("unchanged {}".format(relative_path))
+                counts['unchanged'] += 1
+                a.size, a.mtime = size, mtime
+                assets.append(a)
+                continue
+
+        if document is not None:
+            header, body = _parse_content_header(document)
+            metadata = _parse_metadata(header, config)
         else:
             metadata = {}
+            body = None
 
-        # compute the file's checksum
+        # compute the file's checksums
         with open(path,'rb') as f:
             checksum = util.checksum(f)
-
-        a = Asset.get(site=site, path=relative_path)
+            digest = util.digest(f)
 
         if a is None:
+            logger.debug("new {}".format(relative_path))
+            counts['new'] += 1
             a = Asset(site=site, path=relative_path)
+        else:
+            logger.debug("updated {}".format(relative_path))
+            counts['updated'] += 1
 
         for k, v in metadata.items():
             setattr(a, k, v)
 
         a.checksum = checksum
+        a.digest = digest
+        a.metadata_checksum = metadata_checksum
+        a.size, a.mtime = size, mtime
         a.site = site
         if body:
             a.body = body
         assets.append(a)
 
-    return assets
-
+    deleted = _deleted(existing, config['asset_source_path'], missing)
+    _remove_deleted(deleted)
 
-def discover_assets(path):
-    asset_files = []
-    logger.info("crawling {}".format(path))
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            extension = os.path.splitext(f)[-1][1:].lower()
-            if extension != 'metadata':
-                path = os.path.join(root, f)
-                asset_files.append(path)
-                logger.debug("collected {}".format(path))
-
-    return asset_files
+    # what was not among the changed paths is unchanged
+    counts['unchanged'] += len(existing)
+    _report_ingest('assets', counts, deleted)
+    assets.extend(existing.values())
+    return assets
 
 
-def ingest_content(site, config):
+def ingest_content(site, config, changed=None, existing=None):
+    """
+    the documents of `site`, updated from `content_source_path`; just the
+    `changed` paths are read when given, the rest are taken from `existing`
+    """
     # compute allowed extensions
     extensions = []
     for f in config['document_formats']:
         if f == 'markdown':
             extensions.extend(['md', 'markdown'])
 
-    content_files = discover_content(config['content_source_path'], extensions)
+    content_files, missing = _source_files(config['content_source_path'], changed,
+                                           extensions=extensions,
+                                           ignore=config['ignore'])
     content = []
-    for f in content_files:
-        relative_path = os.path.relpath(f, config['content_source_path'])
-        with open(f, 'rb') as f:
+
+    # every existing document is loaded at once, rather than queried per file
+    if existing is None:
+        existing = {c.path: c for c in site._content}
+    else:
+        existing = dict(existing)
+    counts = dict(new=0, updated=0, unchanged=0)
+    for path, size, mtime in content_files:
+        relative_path = os.path.relpath(path, config['content_source_path'])
+        c = existing.pop(relative_path, None)
+
+        # stat unchanged, assume contents are too
+        if config['incremental'] and c is not None and\
+                (c.size, c.mtime) == (size, mtime):
+            logger.debug("unchanged {}".format(relative_path))
+            counts['unchanged'] += 1
+            content.append(c)
+            continue
+
+        with open(path, 'rb') as f:
+            checksum = util.checksum(f)
+
+            # stat changed but contents did not, e.g. a touched file
+            if config['incremental'] and c is not None and\
+                    c.checksum == checksum:
+                logger.debug("unchanged {}".format(relative_path))
+                counts['unchanged'] += 1
+                c.size, c.mtime = size, mtime
+                content.append(c)
+                continue
+
             document = f.read()
             metadata, body = parse_document(document, config)
-            c = Content.get(site=site, path=relative_path)
 
             if c is None:
+                logger.debug("new {}".format(relative_path))
+                counts['new'] += 1
                 c = Content(site=site, path=relative_path)
+            else:
+                logger.debug("updated {}".format(relative_path))
+                counts['updated'] += 1
 
             for k, v in metadata.items():
                 setattr(c, k, v)
 
             c.body = body
+            c.checksum = checksum
+            c.size, c.mtime = size, mtime
             content.append(c)
 
+    deleted = _deleted(existing, config['content_source_path'], missing)
+    _remove_deleted(deleted)
+
+    # what was not among the changed paths is unchanged
+    counts['unchanged'] += len(existing)
+    _report_ingest('documents', counts, deleted)
+    content.extend(existing.values())
     return content
 
 
-def discover_content(path, extensions):
-    content_files = []
-    logger.info("crawling {}".format(path))
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            extension = os.path.splitext(f)[-1][1:].lower()
-            if extension in extensions:
-                path = os.path.join(root, f)
-                content_files.append(path)
-                logger.debug("collected {}".format(path))
-            else:
-                logger.debug("ignoring {}".format(path))
+def _source_files(root, changed, extensions=None, ignore=()):
+    # the files to ingest and the paths which no longer exist, or a crawl of
+    # every file and None
+    if changed is not None:
+        files = util.stat_files(root, changed, extensions=extensions, ignore=ignore)
+        if files is not None:
+            return files
+    return util.crawl(root, extensions=extensions, ignore=ignore), None
+
+
+def _metadata_owners(paths):
+    for p in paths:
+        stem, extension = os.path.splitext(p)
+        dirname = os.path.dirname(p)
+        if extension == '.metadata' and os.path.isdir(dirname):
+            for name in os.listdir(dirname):
+                path = os.path.join(dirname, name)
+                if path != p and os.path.splitext(path)[0] == stem:
+                    yield path
+
+
+def _deleted(existing, root, missing):
+    # without the missing paths, whatever was not crawled has been deleted
+    if missing is None:
+        deleted = dict(existing)
+        existing.clear()
+        return deleted
+
+    missing = [os.path.relpath(p, root) for p in missing]
+    deleted = {}
+    for path in list(existing):
+        if any(path == m or path.startswith(m + os.sep) for m in missing):
+            deleted[path] = existing.pop(path)
+    return deleted
+
+
+def _remove_deleted(existing):
+    # whatever was not encountered on disk has been deleted
+    session = model.get_session()
+    for path, obj in existing.items():
+        logger.debug("deleted {}".format(path))
+        session.delete(obj)
 
-        for d in dirs:
-            path = os.path.join(root, d)
-            content_files.extend(discover_content(path, extensions))
 
-    return content_files
+def _report_ingest(kind, counts, deleted):
+    logger.info("ingested {}: {} new, {} updated, {} unchanged, {} deleted".format(
+        kind, counts['new'], counts['updated'], counts['unchanged'], len(deleted)))
 
 
 def _parse_content_header(document):
@@ -421,8 +835,6 @@ def _parse_metadata(document, config):
     # If a line is indented by 4 or more spaces, that line is assumed to be an
     # additional line of the value for the previous keyword. A keyword may have
     # as many lines as desired.
-    session = model.get_session()
-
     meta = {}
     current_key = None
     metadata, _ = _parse_content_header(document)
@@ -470,15 +882,7 @@ def _parse_metadata(document, config):
             if not isinstance(v, list):
                 v = map(lambda s: s.strip(), v.split(u','))
 
-            tags = []
-            for t in v:
-                tag = Tag.get(slug=t)
-                if not tag:
-                    tag = Tag(name=t)
-                    session.add(tag)
-                tags.append(tag)
-
-            meta[k] = tags
+            meta[k] = model.get_tag_registry().resolve(v)
 
     if 'time' in meta:
         meta[u'publish_time'] = meta['time']
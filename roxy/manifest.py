@@ -0,0 +1,64 @@
+import os
+import logging
+
+import roxy.util as util
+from roxy.model import Output, get_session
+
+
+logger = logging.getLogger('roxy')
+
+
+class Manifest(object):
+    """
+    the digests of the documents written to `build_path`, used to skip
+    writing documents which have not changed and to remove documents which
+    are no longer generated
+    """
+    def __init__(self, config):
+        self.config = config
+        self.outputs = {}
+        self.written = 0
+        self.skipped = 0
+        self.removed = 0
+
+    def load(self):
+        self.outputs = {o.path: o for o in Output.query.all()}
+        return self
+
+    def write(self, path, content):
+        output = self.outputs.get(path)
+        previous = output.digest if output is not None else None
+
+        filename = util.output_path(self.config['build_path'], path)
+        digest, written = util.write(filename, content, digest=previous)
+        if written:
+            logger.info("writing {}".format(filename))
+            self.written += 1
+        else:
+            self.skipped += 1
+
+        if output is None:
+            output = self.outputs[path] = Output(path=path)
+            get_session().add(output)
+        output.digest = digest
+
+    def prune(self, live_paths):
+        """removes documents which were written before but not generated now"""
+        session = get_session()
+        for path in set(self.outputs) - set(live_paths):
+            filename = util.output_path(self.config['build_path'], path)
+            if os.path.exists(filename):
+                logger.info("removing {}".format(filename))
+                os.remove(filename)
+            session.delete(self.outputs.pop(path))
+            self.removed += 1
+
+    def reset(self):
+        """zeroes the counts logged by `report`, e.g. between builds"""
+        self.written = 0
+        self.skipped = 0
+        self.removed = 0
+
+    def report(self):
+        logger.info("wrote {} documents, skipped {} unchanged, removed {}".format(
+            self.written, self.skipped, self.removed))
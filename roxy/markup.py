@@ -0,0 +1,184 @@
+import re
+import cgi
+import json
+import hashlib
+import logging
+from HTMLParser import HTMLParser
+
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+from roxy.model import Rendering, get_session
+
+
+logger = logging.getLogger('roxy')
+
+
+class RenderCache(object):
+    """
+    HTML converted from markdown, keyed by a digest of the source and of the
+    conversion settings. Each entry also stores the value of every reference
+    it dereferenced, and is only reused while they all resolve the same way,
+    so a changed route invalidates just the entries which refer to it.
+
+    Unless `persist`, new entries are kept aside for `drain` rather than
+    added to the session, e.g. in a worker process which can't write to the
+    content store.
+
+    The keys used since the last `reset` are tracked, so that after a build
+    which rendered every document `prune` can remove the rest.
+    """
+    def __init__(self, settings, persist=True):
+        self.settings = settings
+        self.persist = persist
+        self.entries = {}
+        self.pending = []
+        self.used = set()
+
+    def key(self, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf8')
+        h = hashlib.sha1(repr(self.settings))
+        h.update(source)
+        return h.hexdigest()
+
+    def get(self, key, dereference):
+        """the cached HTML, or None if missing or any reference has changed"""
+        if key not in self.entries:
+            self.entries[key] = Rendering.query.get(key)
+
+        entry = self.entries[key]
+        if entry is None:
+            return None
+
+        self.used.add(key)
+        for ref, value in json.loads(entry.references):
+            try:
+                if unicode(dereference(ref)) != value:
+                    return None
+            except KeyError:
+                return None
+
+        return entry.html
+
+    def put(self, key, html, references):
+        self.used.add(key)
+        references = json.dumps([(ref, unicode(v)) for ref, v in references])
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = Rendering(digest=key)
+            if self.persist:
+                get_session().add(entry)
+        entry.html = html
+        entry.references = references
+
+        if not self.persist:
+            self.pending.append((key, html, references))
+
+    def drain(self):
+        """the entries added and the keys used since the last call, see `persist`"""
+        pending, self.pending = self.pending, []
+        used, self.used = self.used, set()
+        return pending, used
+
+    def absorb(self, drained):
+        """adds entries drained from another cache"""
+        entries, used = drained
+        self.used |= used
+        session = get_session()
+        for key, html, references in entries:
+            entry = self.entries.get(key) or Rendering.query.get(key)
+            if entry is None:
+                entry = Rendering(digest=key)
+                session.add(entry)
+            entry.html = html
+            entry.references = references
+            self.entries[key] = entry
+
+    def reset(self):
+        """forgets the entries loaded and keys used, e.g. between builds"""
+        self.entries = {}
+        self.pending = []
+        self.used = set()
+
+    def prune(self):
+        """removes the entries which weren't used since the last `reset`"""
+        stale = [d for d, in get_session().query(Rendering.digest)
+                 if d not in self.used]
+        for i in range(0, len(stale), 500):
+            Rendering.query.\
+                filter(Rendering.digest.in_(stale[i:i + 500])).\
+                delete(synchronize_session=False)
+        for key in stale:
+            self.entries.pop(key, None)
+        if stale:
+            logger.info("removed {} unused renderings".format(len(stale)))
+
+
+class ReferenceTreeprocessor(Treeprocessor):
+    # the attributes which may hold `key:ref` references
+    attributes = {
+        'a': ('href', 'title'),
+        'img': ('src', 'alt'),
+    }
+
+    # raw HTML is stashed rather than parsed into the tree, so references in
+    # it are found in the markup
+    tag_pattern = re.compile(r'<(a|img)\b([^>]*)>', re.I)
+    attribute_pattern = re.compile(
+        r"""(\b([a-z]+)\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+
+    def __init__(self, md, resolve):
+        Treeprocessor.__init__(self, md)
+        self.resolve = resolve
+
+    def run(self, root):
+        for el in root.iter():
+            for attr in self.attributes.get(el.tag, ()):
+                value = el.get(attr)
+                if value is not None and ':' in value:
+                    el.set(attr, self.resolve(el.tag, attr, value))
+
+        # inline and block HTML are both stashed by the time this runs
+        stash = self.markdown.htmlStash
+        for i, block in enumerate(stash.rawHtmlBlocks):
+            if isinstance(block, tuple):
+                stash.rawHtmlBlocks[i] = (self.resolve_html(block[0]),) + block[1:]
+            else:
+                stash.rawHtmlBlocks[i] = self.resolve_html(block)
+
+    def resolve_html(self, html):
+        """`html` with references in the attributes of its links and images resolved"""
+        def tag(match):
+            name = match.group(1).lower()
+            attributes = self.attribute_pattern.sub(
+                lambda m: self._resolve_attribute(name, m), match.group(2))
+            return u'<{}{}>'.format(match.group(1), attributes)
+
+        return self.tag_pattern.sub(tag, html)
+
+    def _resolve_attribute(self, tag, match):
+        attr = match.group(2).lower()
+        value = next(v for v in match.group(3, 4, 5) if v is not None)
+        value = HTMLParser().unescape(value)
+        if attr not in self.attributes[tag] or ':' not in value:
+            return match.group(0)
+
+        value = self.resolve(tag, attr, value)
+        return u'{}"{}"'.format(match.group(1), cgi.escape(value, quote=True))
+
+
+class ReferenceExtension(Extension):
+    """
+    resolves `key:ref` references in links and images while the document
+    tree is built, and in links and images written as raw HTML, by calling
+    `resolve(tag, attribute, value)`
+    """
+    def __init__(self, resolve):
+        Extension.__init__(self)
+        self.resolve = resolve
+
+    def extendMarkdown(self, md, md_globals):
+        # after inline patterns have produced the links and images
+        processor = ReferenceTreeprocessor(md, self.resolve)
+        md.treeprocessors.add('references', processor, '_end')
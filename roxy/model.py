@@ -1,18 +1,22 @@
 import os
+import re
 import mimetypes
 import logging
+from contextlib import contextmanager
 from datetime import datetime, date
+from decimal import Decimal
 from dateutil.tz import tzutc
 import dateutil.parser
 
-from sqlalchemy import and_, or_, func, asc as ascending, desc as descending, event
+from sqlalchemy import and_, or_, func, asc as ascending, desc as descending, event,\
+    select, intersect, inspect, distinct, false
 from sqlalchemy.types import *
-from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, aliased, mapper
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, mapper,\
+    subqueryload, deferred, load_only
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.schema import UniqueConstraint, Table, Column
+from sqlalchemy.schema import UniqueConstraint, Table, Column, Index
 from batteries.model import Model, initialize_model
 from batteries.model.hashable import Hashable, HashableReference, HashableKey, HashableAssociation
 from batteries.model.serializable import Serializable
@@ -36,6 +40,97 @@ def get_session():
     return _session
 
 
+_eager_loading = False
+
+@contextmanager
+def eager_loading():
+    """makes `PropertyQuery` eager load results unless told otherwise"""
+    global _eager_loading
+    previous = _eager_loading
+    _eager_loading = True
+    try:
+        yield
+    finally:
+        _eager_loading = previous
+
+
+@contextmanager
+def bulk_load():
+    """
+    makes the enclosed changes in one transaction, without flushing before
+    each query, committing them at the end or rolling them back on error
+    """
+    session = get_session()
+    try:
+        with session.no_autoflush:
+            yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+
+@contextmanager
+def recording_changes():
+    """
+    collects the objects added or changed, and those deleted, by the flushes
+    made within, keyed by their id
+    """
+    touched = {}
+    removed = {}
+
+    def collect(session, context, instances):
+        for o in list(session.new) + list(session.dirty):
+            touched[id(o)] = o
+        for o in session.deleted:
+            removed[id(o)] = o
+
+    session = get_session()
+    event.listen(session, 'before_flush', collect)
+    try:
+        yield touched, removed
+    finally:
+        event.remove(session, 'before_flush', collect)
+
+
+SQLITE_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SQLITE_SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+def set_pragmas(engine, journal_mode=None, synchronous=None, cache_size=None,
+                mmap_size=None):
+    """
+    sets the given SQLite pragmas on every connection made by `engine`;
+    `cache_size` is in kibibytes and `mmap_size` in bytes
+    """
+    pragmas = []
+    if journal_mode is not None:
+        if journal_mode.lower() not in SQLITE_JOURNAL_MODES:
+            raise ValueError("unknown journal_mode {!r}".format(journal_mode))
+        pragmas.append(('journal_mode', journal_mode.lower()))
+    if synchronous is not None:
+        if synchronous.lower() not in SQLITE_SYNCHRONOUS:
+            raise ValueError("unknown synchronous {!r}".format(synchronous))
+        pragmas.append(('synchronous', synchronous.lower()))
+    if cache_size is not None:
+        # a negative size is in kibibytes rather than pages
+        pragmas.append(('cache_size', -int(cache_size)))
+    if mmap_size is not None:
+        pragmas.append(('mmap_size', int(mmap_size)))
+
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+    logger.debug("sqlite pragmas {}".format(
+        ', '.join('{}={}'.format(*p) for p in pragmas)))
+
+
 def initialize(engine, create=False, drop=False):
     global _session
 
@@ -49,10 +144,23 @@ def initialize(engine, create=False, drop=False):
     if create:
         logger.info("creating tables in {engine.url!s}".format(engine=engine))
         Model.metadata.create_all(engine)
+        _create_indexes(engine)
 
     return _session
 
 
+def _create_indexes(engine):
+    # create_all skips tables which exist, along with any indexes added to
+    # them since they were created
+    inspector = inspect(engine)
+    for table in Model.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("creating index {}".format(index.name))
+                index.create(engine)
+
+
 def _handle_property(instance, name):
     mapper = instance.__mapper__
     if (mapper.has_property(name) or
@@ -102,11 +210,11 @@ class Site(Hashable, Identifiable, Model):
 
     @property
     def content(self):
-        return PropertyQuery(self._content, Content, content_property)
+        return PropertyQuery(self._content, Content, content_property, content_tag)
 
     @property
     def assets(self):
-        return PropertyQuery(self._assets, Asset, asset_property)
+        return PropertyQuery(self._assets, Asset, asset_property, asset_tag)
 
     @property
     def tags(self):
@@ -125,12 +233,15 @@ class Content(Hashable, Identifiable, PropertyContainer, Model, Recordable):
     _slug = Column('slug', Ascii(100), unique=True)
 
     title = Column(UnicodeText, nullable=False)
-    body = Column(UnicodeText, nullable=False)
+    # listings rarely need the body, so it is loaded on first access
+    body = deferred(Column(UnicodeText, nullable=False))
 
     publish_time = Column(UTCDateTime)
     path = Column(UnicodeText, nullable=False)
 
-    # checksum = Column(Integer)
+    size = Column(Integer)
+    mtime = Column(Float)
+    checksum = Column(Integer)
 
     site = relationship('Site')
     tags = relationship('Tag', secondary='content_tag')
@@ -141,9 +252,11 @@ class Content(Hashable, Identifiable, PropertyContainer, Model, Recordable):
                            single_parent=True,
                            cascade='all, delete-orphan')
 
-    def as_dict(self):
+    def as_dict(self, include_deferred=True):
         d = {}
         for k in ('key', 'slug', 'title', 'body', 'publish_time', 'path'):
+            if k == 'body' and not include_deferred:
+                continue
             d[k] = getattr(self, k)
 
         d['tags'] = [t.name for t in self.tags]
@@ -164,7 +277,12 @@ class Asset(Hashable, Identifiable, PropertyContainer, Model, Recordable):
     body = Column(UnicodeText)
     path = Column(UnicodeText, nullable=False)
 
+    size = Column(Integer)
+    mtime = Column(Float)
     checksum = Column(Integer, nullable=False)
+    metadata_checksum = Column(Integer)
+    # SHA-1 of the source, which derivatives such as previews are cached by
+    digest = Column(Ascii(40))
 
     site = relationship('Site')
     tags = relationship('Tag', secondary='asset_tag')
@@ -185,7 +303,7 @@ class Asset(Hashable, Identifiable, PropertyContainer, Model, Recordable):
         m = mimetypes.guess_type('.'.join(self.filename))
         return m
 
-    def as_dict(self):
+    def as_dict(self, include_deferred=True):
         d = {}
         for k in ('key', 'slug', 'body', 'path', 'mimetype'):
             d[k] = getattr(self, k)
@@ -211,13 +329,164 @@ class Tag(Hashable, Identifiable, Model):
 
     content = relationship('Content', secondary='content_tag')
 
-    def as_dict(self):
+    def as_dict(self, include_deferred=True):
         d = {}
         for k in ('key', 'slug', 'name'):
             d[k] = getattr(self, k)
         return d
 
 
+_tag_separators = re.compile(r'[\s_-]+', re.U)
+
+
+class TagRegistry(object):
+    """
+    every `Tag`, loaded with one query and shared by ingestion and
+    `PropertyQuery` for the length of a build
+    """
+    def __init__(self):
+        self._by_slug = None
+        self._by_name = None
+
+    @staticmethod
+    def _normalize(name):
+        """the key a tag is looked up by, its name lowercased and hyphenated like its slug"""
+        return _tag_separators.sub('-', name.strip().lower())
+
+    def _load(self):
+        if self._by_slug is None:
+            self._by_slug = {}
+            self._by_name = {}
+            for t in Tag.query:
+                self._by_slug[t.slug] = t
+                self._by_name[self._normalize(t.name)] = t
+
+    def get(self, name):
+        """the tag with slug or name `name`, ignoring case, or None"""
+        self._load()
+        key = self._normalize(name)
+        return self._by_slug.get(name) or self._by_slug.get(key) or \
+            self._by_name.get(key)
+
+    def resolve(self, names):
+        """the tags with `names`, creating any which don't exist"""
+        tags = []
+        created = []
+        for n in names:
+            t = self.get(n)
+            if t is None:
+                # indexed under the key lookups use, so a differently cased
+                # name later in the build doesn't create a second tag
+                t = Tag(name=n)
+                self._by_name[self._normalize(n)] = t
+                created.append(t)
+            tags.append(t)
+
+        if created:
+            logger.debug("creating {} tags".format(len(created)))
+            get_session().add_all(created)
+        return tags
+
+    def invalidate(self):
+        self._by_slug = None
+        self._by_name = None
+
+
+_tag_registry = TagRegistry()
+def get_tag_registry():
+    return _tag_registry
+
+
+# offsets numbers to be non-negative, Integer columns are at most 2 ** 63
+_sort_offset = Decimal(10) ** 19
+
+def _sort_key(v):
+    """a string which orders the same as `v` does among values of its type"""
+    if v is None:
+        return None
+    if isinstance(v, bool):
+        return u'b{:d}'.format(v)
+    if isinstance(v, (int, long, float, Decimal)):
+        if isinstance(v, float):
+            v = repr(v)
+        return u'n{:027.6f}'.format(Decimal(v) + _sort_offset)
+    if isinstance(v, datetime):
+        if v.tzinfo is not None:
+            v = v.astimezone(tzutc()).replace(tzinfo=None)
+        return u't{}'.format(v.isoformat())
+    if isinstance(v, date):
+        return u't{}'.format(v.isoformat())
+    return u's{}'.format(v)
+
+
+class IdentityIndex(object):
+    """
+    every `Content`, `Asset` and `Tag` of a site by key, slug and path,
+    loaded with one query per class the first time it is used
+    """
+    identifiers = ('key', 'slug', 'path')
+
+    def __init__(self, site):
+        self.site = site
+        self._index = None
+        self._entries = {}
+
+    def _load(self):
+        if self._index is None:
+            self._index = {}
+            sources = (('content', self.site._content),
+                       ('asset', self.site._assets),
+                       ('tag', Tag.query))
+            for name, objects in sources:
+                self._index[name] = {i: {} for i in self.identifiers}
+                for o in objects:
+                    self._add(o)
+
+            logger.debug("indexed {} objects".format(
+                sum(len(i['key']) for i in self._index.values())))
+
+    def update(self, objects=(), removed=()):
+        """reindexes `objects` and drops `removed`, if the index is loaded"""
+        if self._index is None:
+            return
+
+        objects = list(objects)
+        for o in objects + list(removed):
+            self._discard(o)
+        for o in objects:
+            self._add(o)
+
+    def _add(self, o):
+        index = self._index.get(o.__class__.__name__.lower())
+        if index is None:
+            return
+
+        entries = self._entries[id(o)] = []
+        for i in self.identifiers:
+            v = getattr(o, i, None)
+            if v is not None:
+                index[i][v] = o
+                entries.append((index[i], v))
+
+    def _discard(self, o):
+        for identifiers, v in self._entries.pop(id(o), ()):
+            if identifiers.get(v) is o:
+                del identifiers[v]
+
+    def get(self, cls_, key):
+        """the object of class `cls_` with key, slug or path `key`"""
+        self._load()
+        index = self._index.get(cls_.lower())
+        if index is None:
+            raise KeyError("{!r} is not one of {}".format(cls_, ', '.join(self._index)))
+
+        for i in self.identifiers:
+            if key in index[i]:
+                return index[i][key]
+
+        raise KeyError("no {} has key, slug or path {!r}".format(cls_.lower(), key))
+
+
 class Property(Hashable, Model):
     __identifiers__ = ('name', 'value')
     serializable = ('content_key', 'name', 'value', 'type')
@@ -232,6 +501,9 @@ class Property(Hashable, Model):
     datetime_value = Column(UTCDateTime)
     str_value = Column(UnicodeText)
 
+    # orders like the typed value, so that sorts can be read from an index
+    sort_key = Column(UnicodeText)
+
     @property
     def type(self):
         if self.bool_value:
@@ -269,6 +541,10 @@ class Property(Hashable, Model):
 
     @value.setter
     def value(self, v):
+        self._assign_value(v)
+        self.sort_key = _sort_key(self.value)
+
+    def _assign_value(self, v):
         self._reset_value()
 
         # null
@@ -339,11 +615,87 @@ class Property(Hashable, Model):
         return d
 
 
+class Dependency(Model):
+    """an input which was used to render the output at `path`"""
+    id = Column(Integer, primary_key=True)
+    path = Column(UnicodeText, nullable=False, index=True)
+    kind = Column(Ascii(20), nullable=False)
+    ref = Column(UnicodeText, nullable=False)
+    digest = Column(UnicodeText)
+
+
+class Output(Model):
+    """the digest of the document last written to `path`"""
+    path = Column(UnicodeText, primary_key=True)
+    digest = Column(Ascii(40), nullable=False)
+
+
+class Rendering(Model):
+    """markdown converted to HTML, see `roxy.markup.RenderCache`"""
+    digest = Column(Ascii(40), primary_key=True)
+    html = Column(UnicodeText, nullable=False)
+    references = Column(UnicodeText, nullable=False)
+
+
 class PropertyQuery(object):
-    def __init__(self, relationship, model, assoc_table):
-        self.query = relationship.join(model._properties)
+    def __init__(self, relationship, model, assoc_table, tag_table):
+        self.query = relationship
         self.model = model
         self.assoc_table = assoc_table
+        self.tag_table = tag_table
+        self.eager = None
+
+    @classmethod
+    def _owner_key(cls, table):
+        # e.g. content_property.c.content_key
+        fk_name = '_'.join(table.name.split('_')[:-1] + ['key'])
+        return getattr(table.c, fk_name)
+
+    def _property_subquery(self, name, v):
+        """the keys of models having a property `name` which matches `v`"""
+        column = PropertyQuery._derive_property_type(v)
+        criteria = PropertyQuery._parse_criteria(column, v)
+        return select([self._owner_key(self.assoc_table)]).\
+            where(and_(self.assoc_table.c.property_key == Property.key,
+                       Property.name == name,
+                       criteria))
+
+    def _tag_subquery(self, c):
+        """
+        the keys of models tagged with all of the tags in `c`, or any of them
+        if `c` is `{'any': [...]}`; None if no model can match
+        """
+        mode = 'all'
+        if isinstance(c, dict):
+            if len(c) != 1 or c.keys()[0] not in ('all', 'any'):
+                raise ValueError(c)
+            mode, c = c.items()[0]
+
+        if not isinstance(c, list):
+            c = [c]
+
+        # a tag named twice, or by its name and its slug, counts once
+        tag_keys = set()
+        unresolved = 0
+        registry = get_tag_registry()
+        for t in c:
+            if not isinstance(t, Tag):
+                t = registry.get(t.lower())
+            if t:
+                tag_keys.add(t.key)
+            else:
+                unresolved += 1
+
+        if not tag_keys or (mode == 'all' and unresolved):
+            return None
+
+        owner_key = self._owner_key(self.tag_table)
+        tag_key = self.tag_table.c.tag_key
+        query = select([owner_key]).where(tag_key.in_(tag_keys))
+        if mode == 'all':
+            query = query.group_by(owner_key).\
+                having(func.count(distinct(tag_key)) == len(tag_keys))
+        return query
 
     @classmethod
     def _derive_property_type(cls, v):
@@ -444,7 +796,7 @@ class PropertyQuery(object):
                     if insensitive:
                         v = v.lower()
                     clauses.append(column.startswith(v))
-                if 'endswith' in criteria:
+                if k == 'endswith':
                     if insensitive:
                         v = v.lower()
                     clauses.append(column.endswith(v))
@@ -479,6 +831,7 @@ class PropertyQuery(object):
         raise ValueError(column.key)
 
     def filter(self, **kwargs):
+        subqueries = []
         for k, v in kwargs.items():
             if self.model.__mapper__.has_property(k):
                 if k not in ('tags',):
@@ -487,36 +840,62 @@ class PropertyQuery(object):
                     self.query = self.query.filter(c)
 
                 elif k in ('tags',):
-                    if not isinstance(v, list):
-                        v = [v]
-
-                    tag_keys = []
-                    for t in v:
-                        if isinstance(t, Tag):
-                            tag_keys.append(t.key)
-                        else:
-                            t = Tag.get(slug=t.lower())
-                            if t:
-                                tag_keys.append(t.key)
-
-                    clauses = [Tag.key == k for k in tag_keys]
-                    clause = and_(*(self.model.tags.any(c) for c in clauses))
-                    self.query = self.query.filter(clause).group_by(self.model.key)
+                    subquery = self._tag_subquery(v)
+                    if subquery is None:
+                        self.query = self.query.filter(false())
+                    else:
+                        subqueries.append(subquery)
 
             else:
-                clause = []
-                clause.append(Property.name == k)
-                column = PropertyQuery._derive_property_type(v)
-                clause.append(PropertyQuery._parse_criteria(column, v))
-                self.query = self.query.filter(and_(*clause))
+                subqueries.append(self._property_subquery(k, v))
 
+        # each subquery is answered from an index, and their intersection is
+        # computed once rather than per row
+        if len(subqueries) == 1:
+            self.query = self.query.filter(self.model.key.in_(subqueries[0]))
+        elif subqueries:
+            self.query = self.query.filter(self.model.key.in_(intersect(*subqueries)))
+
+        return self
+
+    def only(self, *names):
+        """
+        load only the named columns of each result, the rest are loaded on
+        first access, e.g. `.only('title', 'slug', 'publish_time')`
+        """
+        mapper = self.model.__mapper__
+        keys = []
+        for n in names:
+            if mapper.has_property(n):
+                keys.append(n)
+            elif mapper.has_property('_' + n):
+                keys.append('_' + n)
+            else:
+                raise ValueError(n)
+
+        self.query = self.query.options(load_only(*keys))
+        return self
+
+    def eager_load(self, eager=True):
+        """
+        load the tags and properties of every result with one query each,
+        rather than one query per result as they are accessed
+        """
+        self.eager = eager
         return self
 
+    def _loading_query(self):
+        eager = self.eager if self.eager is not None else _eager_loading
+        if eager:
+            return self.query.options(subqueryload(self.model.tags),
+                                      subqueryload(self.model._properties))
+        return self.query
+
     def all(self):
-        return self.query.all()
+        return self._loading_query().all()
 
     def one(self):
-        return self.query.one()
+        return self._loading_query().one()
 
     def limit(self, l):
         self.query = self.query.limit(l)
@@ -527,6 +906,10 @@ class PropertyQuery(object):
         return self
 
     def order_by(self, asc=None, desc=None):
+        """
+        sorts by columns or properties; models which don't have a property
+        sort after those which do
+        """
         if asc:
             if not isinstance(asc, list):
                 asc = [asc]
@@ -545,18 +928,16 @@ class PropertyQuery(object):
                 column = getattr(self.model, c)
                 sorts.append(column)
             else:
-                aliased_assoc = aliased(self.assoc_table)
-                aliased_property = aliased(Property, name=c)
-                fk_name = '_'.join(self.assoc_table.name.split('_')[:-1] + ['key'])
-                fk = getattr(aliased_assoc.c, fk_name)
-                self.query = self.query.\
-                        outerjoin(aliased_assoc,
-                                  fk == self.model.key).\
-                        outerjoin(aliased_property,
-                                  and_(aliased_assoc.c.property_key == Property.key,
-                                       Property.name == c))
-
-                sorts.append((c, aliased_property))
+                # one row per model, read from the `(name, sort_key)` index
+                owner_key = self._owner_key(self.assoc_table)
+                sort = select([owner_key.label('owner_key'),
+                               Property.sort_key.label('sort_key')]).\
+                    where(and_(self.assoc_table.c.property_key == Property.key,
+                               Property.name == c)).\
+                    alias('sort_{}'.format(c))
+                self.query = self.query.outerjoin(sort, sort.c.owner_key == self.model.key)
+
+                sorts.append((c, sort))
 
         for s in sorts:
             if isinstance(s, tuple):
@@ -566,14 +947,9 @@ class PropertyQuery(object):
                 if c in desc:
                     f = descending
 
-                ordering = f(coalesce(
-                                alias.bool_value,
-                                alias.int_value,
-                                alias.float_value,
-                                alias.date_value,
-                                alias.datetime_value,
-                                alias.str_value))
-                self.query = self.query.order_by(ordering)
+                # missing values last, whichever the direction
+                self.query = self.query.order_by(alias.c.sort_key.is_(None),
+                                                 f(alias.c.sort_key))
             else:
                 if s.key in asc:
                     self.query = self.query.order_by(s.asc())
@@ -594,3 +970,16 @@ asset_tag = HashableAssociation('asset', 'tag')
 content_property = HashableAssociation('content', 'property')
 asset_property = HashableAssociation('asset', 'property')
 site_property = HashableAssociation('site', 'property')
+
+# property filters select on (name, value) and then find owners by property
+for _column in ('bool_value', 'int_value', 'float_value', 'date_value',
+                'datetime_value', 'str_value'):
+    Index('ix_property_name_{}'.format(_column), Property.name, getattr(Property, _column))
+Index('ix_property_name_sort_key', Property.name, Property.sort_key)
+
+for _assoc in (content_property, asset_property, site_property):
+    Index('ix_{}_property_key'.format(_assoc.name), _assoc.c.property_key)
+
+# tag filters find owners by tag
+for _assoc in (content_tag, asset_tag):
+    Index('ix_{}_tag_key'.format(_assoc.name), _assoc.c.tag_key)
@@ -0,0 +1,129 @@
+import json
+import time
+import cProfile
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import roxy.events as events
+
+
+logger = logging.getLogger('roxy')
+_profiler = None
+
+
+class Profiler(object):
+    """
+    times build phases, counting the SQL statements issued in each, and
+    individual operations such as generators, template renders and images;
+    the report includes the subscriber stats of every event
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.timings = {}
+        self._stack = []
+
+    def enter(self, name):
+        now = time.time()
+        # phases are timed exclusively, the enclosing phase is paused
+        if self._stack:
+            parent = self._stack[-1]
+            self._phase(parent[0])['seconds'] += now - parent[1]
+        self._stack.append([name, now])
+        self._phase(name)['count'] += 1
+
+    def exit(self):
+        now = time.time()
+        name, start = self._stack.pop()
+        self._phase(name)['seconds'] += now - start
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = dict(count=0, seconds=0.0, statements=0)
+        return self.phases[name]
+
+    def count_statement(self, *args, **kwargs):
+        name = self._stack[-1][0] if self._stack else None
+        self._phase(name)['statements'] += 1
+
+    def time(self, category, name, seconds):
+        timings = self.timings.setdefault(category, {})
+        if name not in timings:
+            timings[name] = dict(count=0, seconds=0.0, max=0.0)
+        t = timings[name]
+        t['count'] += 1
+        t['seconds'] += seconds
+        t['max'] = max(t['max'], seconds)
+
+    def report(self):
+        return {
+            'seconds': time.time() - self.start,
+            'phases': self.phases,
+            'timings': self.timings,
+            'events': events.stats(),
+        }
+
+
+@contextmanager
+def phase(name):
+    """times a build phase, when profiling"""
+    if _profiler is None:
+        yield
+        return
+
+    _profiler.enter(name)
+    try:
+        yield
+    finally:
+        _profiler.exit()
+
+
+@contextmanager
+def timed(category, name):
+    """times an operation within a phase, when profiling"""
+    if _profiler is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        _profiler.time(category, name, time.time() - start)
+
+
+@contextmanager
+def profiling(engine, report=None, pstats=None):
+    """
+    profiles the enclosed build, writing a JSON report to `report` and a
+    cProfile dump to `pstats`, whichever are given
+    """
+    global _profiler
+    if not report and not pstats:
+        yield
+        return
+
+    _profiler = Profiler()
+    event.listen(engine, 'before_cursor_execute', _profiler.count_statement)
+    profile = cProfile.Profile() if pstats else None
+    if profile:
+        profile.enable()
+
+    try:
+        yield _profiler
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(pstats)
+            logger.info("wrote profile to {}".format(pstats))
+
+        event.remove(engine, 'before_cursor_execute', _profiler.count_statement)
+        if report:
+            with open(report, 'wb') as f:
+                json.dump(_profiler.report(), f, indent=2, sort_keys=True)
+            logger.info("wrote profile report to {}".format(report))
+        _profiler = None
@@ -1,8 +1,26 @@
 import os
+import stat
 import shutil
+import hashlib
 import logging
+import tempfile
+from fnmatch import fnmatch
+from contextlib import contextmanager
 from zlib import crc32
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# mkstemp creates files readable only by their owner
+_umask = os.umask(0)
+os.umask(_umask)
+
 
 def pluck(d, keys):
     return {k: d[k] for k in keys if k in d}
@@ -28,6 +46,134 @@ def checksum(f):
     return cs
 
 
+def digest(f):
+    """the SHA-1 hex digest of the contents of `f`"""
+    pos = f.tell()
+    f.seek(0)
+    h = hashlib.sha1()
+    data = f.read(2 ** 14)
+    while data:
+        h.update(data)
+        data = f.read(2 ** 14)
+
+    f.seek(pos)
+    return h.hexdigest()
+
+
+@contextmanager
+def replacing(path, suffix='.tmp'):
+    """
+    yields a new, uniquely named file beside `path`, which replaces `path` if
+    the enclosed block succeeds and is removed otherwise
+    """
+    fd, temp = tempfile.mkstemp(prefix='.', suffix=suffix,
+                                dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        yield temp
+        os.chmod(temp, 0o666 & ~_umask)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def crawl(root, extensions=None, ignore=()):
+    """
+    walks `root` once, yielding the path, size and modification time of each
+    file with one of `extensions` whose path relative to `root` matches none
+    of the `ignore` globs
+    """
+    logger = logging.getLogger('roxy')
+    logger.info("crawling {}".format(root))
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        subdirectories = []
+        for name, path, is_dir, st in _list_directory(directory):
+            relative_path = os.path.relpath(path, root)
+            if _ignored(relative_path, name, ignore):
+                logger.debug("ignoring {}".format(path))
+                continue
+
+            if is_dir:
+                subdirectories.append(path)
+                continue
+
+            extension = os.path.splitext(name)[-1][1:].lower()
+            if extensions is not None and extension not in extensions:
+                logger.debug("ignoring {}".format(path))
+                continue
+
+            logger.debug("collected {}".format(path))
+            yield path, st.st_size, st.st_mtime
+
+        # visit subdirectories in order
+        pending.extend(reversed(subdirectories))
+
+
+def stat_files(root, paths, extensions=None, ignore=()):
+    """
+    like `crawl`, but of `paths` alone: the path, size and modification time
+    of each of them beneath `root` which `crawl` would yield, and the paths
+    which no longer exist; None if one is a directory, which has to be
+    crawled instead
+    """
+    found = []
+    missing = []
+    for path in paths:
+        relative_path = os.path.relpath(path, root)
+        if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+            continue
+        if relative_path == os.curdir:
+            return None
+
+        parts = relative_path.split(os.sep)
+        if any(_ignored(os.sep.join(parts[:i + 1]), parts[i], ignore)
+               for i in range(len(parts))):
+            continue
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            missing.append(path)
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            return None
+
+        extension = os.path.splitext(path)[-1][1:].lower()
+        if extensions is not None and extension not in extensions:
+            continue
+
+        found.append((path, st.st_size, st.st_mtime))
+
+    return found, missing
+
+
+def _ignored(relative_path, name, ignore):
+    return any(fnmatch(relative_path, g) or fnmatch(name, g) for g in ignore)
+
+
+def _list_directory(directory):
+    if scandir is not None:
+        entries = sorted(scandir(directory), key=lambda e: e.name)
+        for e in entries:
+            # like os.walk, symlinked directories are not followed
+            if e.is_dir(follow_symlinks=False):
+                yield e.name, e.path, True, None
+            elif e.is_file():
+                yield e.name, e.path, False, e.stat()
+    else:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                yield name, path, True, None
+            elif os.path.isfile(path):
+                yield name, path, False, os.stat(path)
+
+
 def _make_path(p):
     if isinstance(p, (tuple, list)):
         parts = list(p[:1])
@@ -45,21 +191,82 @@ def _make_path(p):
     return p
 
 
-def write(path, content):
+def output_path(root, path):
+    if path.startswith('/'):
+        path = path[1:]
+    return os.path.join(root, path)
+
+
+def write(path, content, digest=None):
+    """
+    writes `content`, a string or an iterable of chunks, to `path` unless its
+    digest is `digest`, returning the digest of `content` and whether it was
+    written; `path` is replaced atomically, never partially written
+    """
     logger = logging.getLogger('roxy')
     path = _make_path(path)
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    with open(path, 'wb') as f:
-        logger.debug('writing to {}'.format(f.name))
-        f.write(content)
+    exists = os.path.exists(path)
+    if isinstance(content, basestring):
+        # a string is hashed before anything is written, so an unchanged
+        # document costs no temporary file
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        h = hashlib.sha1(content)
+        if exists and h.hexdigest() == digest:
+            logger.debug('unchanged {}'.format(path))
+            return digest, False
+
+        with replacing(path) as temp:
+            with open(temp, 'wb') as f:
+                f.write(content)
+        logger.debug('wrote {}'.format(path))
+        return h.hexdigest(), True
+
+    # an iterable is hashed as it is streamed to a temporary file
+    h = hashlib.sha1()
+    fd, temp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in content:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf8')
+                h.update(chunk)
+                f.write(chunk)
 
+        if exists and h.hexdigest() == digest:
+            logger.debug('unchanged {}'.format(path))
+            os.remove(temp)
+            return digest, False
 
-def copy(src, dest):
+        os.chmod(temp, 0o666 & ~_umask)
+        os.rename(temp, path)
+        logger.debug('wrote {}'.format(path))
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+    return h.hexdigest(), True
+
+
+def copy(src, dest, link=False):
     logger = logging.getLogger('roxy')
     src, dest = map(_make_path, (src, dest))
+    if link:
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+            logger.debug('linking {} to {}'.format(src, dest))
+            return
+        except OSError:
+            # e.g. across devices
+            pass
+
     shutil.copy(src, dest)
     logger.debug('copying {} to {}'.format(src, dest))
 
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from roxy.model import get_session
+
+
+logger = logging.getLogger('roxy')
+
+
+def watch(arguments, config, generate):
+    """
+    serves `build_path` over HTTP and calls `generate` whenever a source
+    changes; the configuration, template environment, session and generator
+    module are shared by every build, along with the `BuildState` of the
+    previous one, so that only the changed sources are ingested
+    """
+    serve(config['build_path'], int(arguments['--port']))
+
+    # objects loaded by one build stay valid for the next, nothing else
+    # writes to the content store meanwhile
+    get_session()().expire_on_commit = False
+
+    paths = [config[k] for k in ('content_source_path', 'asset_source_path',
+                                 'template_path')]
+    if pyinotify is not None:
+        changes = _notify(paths, config['build_path'])
+    else:
+        logger.info("pyinotify is not installed, polling for changes")
+        changes = _poll(paths, config['build_path'])
+
+    state = _build(arguments, config, generate)
+    for changed in changes:
+        logger.info("{} changed, rebuilding".format(', '.join(sorted(changed)[:3])))
+        state = _build(arguments, config, generate, state, changed)
+
+
+def _build(arguments, config, generate, state=None, changed=None):
+    """the state to pass to the next build"""
+    start = time.time()
+    try:
+        state = generate(arguments, config, state=state, changed=changed)
+    except Exception:
+        # a broken document or template shouldn't end the session, but the
+        # rollback expires what it loaded so the next build starts over
+        logger.exception("build failed")
+        get_session().rollback()
+        return None
+
+    logger.info("built in {:.2f}s".format(time.time() - start))
+    return state
+
+
+def serve(root, port):
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = SimpleHTTPRequestHandler.translate_path(self, path)
+            return os.path.join(root, os.path.relpath(path, os.getcwd()))
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = HTTPServer(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("serving {} at http://127.0.0.1:{}/".format(root, port))
+    return server
+
+
+def _excluded(path, build_path):
+    return path == build_path or path.startswith(build_path + os.sep)
+
+
+def _notify(paths, build_path, settle=0.1):
+    """yields the set of paths changed, as reported by inotify"""
+    changed = set()
+
+    class Handler(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            if not _excluded(event.pathname, build_path):
+                changed.add(event.pathname)
+
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |\
+        pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+    manager = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(manager, Handler())
+    for p in paths:
+        manager.add_watch(p, mask, rec=True, auto_add=True)
+
+    while True:
+        if notifier.check_events(timeout=None):
+            notifier.read_events()
+            notifier.process_events()
+
+        # editors often save with several events, wait for them to settle
+        while notifier.check_events(timeout=settle * 1000):
+            notifier.read_events()
+            notifier.process_events()
+
+        if changed:
+            yield set(changed)
+            changed.clear()
+
+
+def _poll(paths, build_path, interval=0.5):
+    """yields the set of paths changed, found by comparing stat snapshots"""
+    def snapshot():
+        files = {}
+        for p in paths:
+            for root, dirs, names in os.walk(p):
+                dirs[:] = [d for d in dirs
+                           if not _excluded(os.path.join(root, d), build_path)]
+                for n in names:
+                    path = os.path.join(root, n)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = st.st_size, st.st_mtime
+        return files
+
+    previous = snapshot()
+    while True:
+        time.sleep(interval)
+        current = snapshot()
+        changed = set(k for k in set(previous) | set(current)
+                      if previous.get(k) != current.get(k))
+        previous = current
+        if changed:
+            yield changed
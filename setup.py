@@ -39,6 +39,7 @@ setup(
     entry_points={
         'console_scripts': [
             'roxy = roxy.main:main',
+            'roxy-benchmark = roxy.benchmark:main',
         ]
     }
 )